@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from .raw import RawResultTree
 from .tree import ResultTree
 
 
 def flatten_result(es_result, **kwargs):
     return ResultTree(es_result).flatten_result(**kwargs)
+
+
+def iter_lines(es_result, **kwargs):
+    return ResultTree(es_result).iter_lines(**kwargs)
+
+
+def flatten_raw(raw_result, **kwargs):
+    return RawResultTree(raw_result).iter_lines(**kwargs)
@@ -18,6 +18,9 @@ class Metric(object):
     def is_computed(self):
         return False
 
+    def get_casted_values(self, values):
+        return [self.get_casted_value(v) for v in values]
+
 
 class Count(Metric):
     def __init__(self, model_or_field):
@@ -68,15 +71,25 @@ class Aggregate(Metric):
     def choice_keys(self):
         return None
 
+    def has_all_buckets(self):
+        # Whether Elasticsearch returns a bucket for each key, even empty
+        return False
+
     def get_casted_value(self, v):
         return self.field.get_casted_value(v)
 
+    def get_casted_values(self, values):
+        return self.field.get_casted_values(values)
+
 
 class Avg(Aggregate):
     def get_casted_value(self, v):
         """Average of an IntegerField does not have to be an integer"""
         return v
 
+    def get_casted_values(self, values):
+        return list(values)
+
 
 class Max(Aggregate):
     pass
@@ -109,24 +122,42 @@ class Histogram(Aggregate):
         if 'max' in self.params and 'min' not in self.params:
             raise MissingParameterException('cannot give max without min')
 
+        # The params are left untouched, agg_params can be called again
         if 'min' in self.params and 'max' in self.params:
-            self.min = self.params.pop('min')
-            self.max = self.params.pop('max')
-
             params['extended_bounds'] = {
                 'min': self.min,
                 'max': self.max,
             }
 
-        params.update(self.params)
+        params.update({
+            key: value for key, value in self.params.items()
+            if key not in ('min', 'max')
+        })
 
         if 'interval' not in params:
             raise MissingParameterException('missing interval parameter')
 
-        self.interval = params['interval']
-
         return params
 
+    # The bounds and the interval only depend on the params,
+    # agg_params does not need to be called first
+    @property
+    def min(self):
+        return self.params.get('min')
+
+    @property
+    def max(self):
+        return self.params.get('max')
+
+    @property
+    def interval(self):
+        return self.params.get('interval')
+
+    def has_all_buckets(self):
+        # Empty buckets are returned between the bounds
+        return 'min' in self.params and 'max' in self.params\
+            and self.params.get('min_doc_count', 0) == 0
+
 
 TIME_UNIT_CONVERSION = {
     'd': 'days',
@@ -260,16 +291,15 @@ class DateHistogram(Histogram):
     ref = 'date_histogram'
 
     def choice_keys(self):
-        if not hasattr(self, 'min') or not hasattr(self, 'max'):
+        if self.min is None or self.max is None or self.interval is None:
             return None
 
         if not is_interval_handled(self.interval):
             return None
 
         start = get_rounded_date_from_interval(self.min, self.interval)
-        agg_params = self.agg_params()
-        if 'offset' in agg_params:
-            start = get_offset_date(start, agg_params['offset'])
+        if 'offset' in self.params:
+            start = get_offset_date(start, self.params['offset'])
 
         end = self.max
 
@@ -369,6 +399,9 @@ class DateRange(Aggregate):
         start, end = date_range['from'], date_range['to']
         return '{}-{}'.format(self._format_date(start), self._format_date(end))
 
+    def has_all_buckets(self):
+        return True
+
     def choice_keys(self):
         keys = []
 
@@ -383,6 +416,9 @@ class DateRange(Aggregate):
     def get_casted_value(self, v):
         return v
 
+    def get_casted_values(self, values):
+        return list(values)
+
 
 class ReverseNested(Metric):
     def __init__(self, path_or_field_or_model,
@@ -403,6 +439,10 @@ class ReverseNested(Metric):
             self._expressions[str(exp)] = exp
         self._expressions.update(named_expressions)
 
+        # Built on first use, they only depend on the path and expressions
+        self._prefixed_expressions = None
+        self._empty_line = None
+
     def __str__(self):
         keys = '__'.join(self._expressions.keys())
         return 'reverse_nested_{}__{}'.format(self.path, keys)
@@ -439,22 +479,27 @@ class ReverseNested(Metric):
 
     @property
     def expressions(self):
-        return {
-            'reverse_nested_{}__{}'.format(self.path, key): expression
-            for key, expression in self._expressions.items()
-        }
+        if self._prefixed_expressions is None:
+            self._prefixed_expressions = {
+                'reverse_nested_{}__{}'.format(self.path, key): expression
+                for key, expression in self._expressions.items()
+            }
+
+        return self._prefixed_expressions
 
     def create_empty_line(self):
-        line = {}
+        if self._empty_line is None:
+            line = {}
 
-        for key, expression in self.expressions.items():
-            if expression.is_doc_count():
-                continue
-            line[key] = None
+            for key, expression in self.expressions.items():
+                if expression.is_doc_count():
+                    continue
+                line[key] = None
 
-        line['reverse_nested_{}__doc_count'.format(self.path)] = 0
+            line['reverse_nested_{}__doc_count'.format(self.path)] = 0
+            self._empty_line = line
 
-        return line
+        return self._empty_line.copy()
 
 
 class Operation(Metric):
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import MultiSearch, connections
+
+
+def _eval_args(flat=True, fill_missing_buckets=True, add_others_line=False,
+               format='lines', limit=None, offset=0):
+    # Same arguments as FQuery.eval, in the order _eval_result expects them
+    return (flat, fill_missing_buckets, add_others_line, format, limit,
+            offset)
+
+
+def _response_error(response):
+    error = response['error']
+    error_type = error.get('type') if isinstance(error, dict) else error
+    return TransportError(response.get('status', 'N/A'), error_type, error)
+
+
+class _Entry(object):
+    def __init__(self, fquery, args):
+        self.fquery = fquery
+        self.args = args
+        self.search = None
+        self.cache_key = None
+
+    @property
+    def caches_lines(self):
+        return self.fquery._caches_lines(self.args[0])
+
+    def configure(self):
+        flat, _, add_others_line, format, limit, offset = self.args
+        self.search = self.fquery._configure_eval_search(
+            flat, add_others_line, format, limit, offset)
+        self.cache_key = self.fquery._get_cache_key(self.search, *self.args)
+
+    def get_cached(self):
+        return self.fquery._get_cached(self.cache_key)
+
+    def eval_response(self, es_result, cached=False):
+        flat = self.args[0]
+        if not cached:
+            self.fquery._cache_response(self.cache_key, flat, es_result)
+
+        result = self.search._response_class(self.search, es_result)
+        ret = self.fquery._eval_result(result, *self.args)
+
+        self.fquery._cache_lines(self.cache_key, flat, ret)
+        return ret
+
+
+class FQueryBatch(object):
+    """Evaluates several FQuery objects with a single multi search
+
+    The searches of the queries using the same connection are sent in one
+    `_msearch` request, each response is then flattened with the arguments
+    given to `add`. Results are returned in the order the queries were
+    added. A query failing, in Elasticsearch or while flattening its
+    response, does not fail the others: its exception is returned in place
+    of its result.
+    """
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, fquery, **kwargs):
+        # kwargs are the arguments of FQuery.eval
+        self._entries.append(_Entry(fquery, _eval_args(**kwargs)))
+
+        return self
+
+    def eval(self):
+        results = [None] * len(self._entries)
+
+        # Entries to send to Elasticsearch, by connection
+        pending = OrderedDict()
+        for position, entry in enumerate(self._entries):
+            try:
+                entry.configure()
+                cached = entry.get_cached()
+                if cached is None:
+                    pending.setdefault(entry.search._using, []).append(
+                        (position, entry))
+                elif entry.caches_lines:
+                    results[position] = cached
+                else:
+                    results[position] = entry.eval_response(
+                        cached, cached=True)
+            except Exception as e:
+                results[position] = e
+
+        for using, entries in pending.items():
+            try:
+                responses = self._msearch(
+                    using, [entry.search for _, entry in entries])
+            except Exception as e:
+                # The whole request failed, so did each of its searches
+                for position, _ in entries:
+                    results[position] = e
+                continue
+
+            for (position, entry), response in zip(entries, responses):
+                if response.get('error'):
+                    results[position] = _response_error(response)
+                    continue
+
+                try:
+                    results[position] = entry.eval_response(response)
+                except Exception as e:
+                    results[position] = e
+
+        return results
+
+    def _msearch(self, using, searches):
+        multi_search = MultiSearch(using=using)
+        for search in searches:
+            multi_search = multi_search.add(search)
+
+        es = connections.get_connection(using)
+        return es.msearch(body=multi_search.to_dict())['responses']
+
+
+def eval_many(fqueries, **kwargs):
+    """Evaluates the queries with a single multi search, see FQueryBatch
+
+    kwargs are the arguments of FQuery.eval, used for all the queries.
+    """
+    batch = FQueryBatch()
+    for fquery in fqueries:
+        batch.add(fquery, **kwargs)
+
+    return batch.eval()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from elasticsearch.serializer import JSONSerializer
+
+CACHE_FILE_SUFFIX = '.fiqs-cache'
+DEFAULT_MAX_BYTES = 64 * 2 ** 20
+
+
+class LRUCache(object):
+    """In-process cache, dropping the least recently used entries
+
+    It is bounded by its number of entries, and by the total size of its
+    values if they are bytes. It can be shared between threads.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._nb_bytes = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nb_bytes(self):
+        return self._nb_bytes
+
+    def _size(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def _is_full(self):
+        if self.max_entries is not None\
+                and len(self._entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self._nb_bytes > self.max_bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._delete(key)
+
+            # A value larger than the whole cache would evict everything
+            size = self._size(value)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = value
+            self._nb_bytes += size
+
+            while self._is_full():
+                _, evicted_value = self._entries.popitem(last=False)
+                self._nb_bytes -= self._size(evicted_value)
+
+    def _delete(self, key):
+        if key in self._entries:
+            self._nb_bytes -= self._size(self._entries.pop(key))
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nb_bytes = 0
+
+
+class MemoryBackend(LRUCache):
+    """Keeps the cached results in the process, up to `max_bytes`"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        super(MemoryBackend, self).__init__(
+            max_entries=max_entries, max_bytes=max_bytes)
+
+
+class DiskBackend(object):
+    """Keeps the cached results in a local directory, up to `max_bytes`
+
+    Each entry is a file, the least recently used files are removed first.
+    The directory can be shared between processes.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    def _paths(self):
+        return [
+            os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+            if filename.endswith(CACHE_FILE_SUFFIX)
+        ]
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except (IOError, OSError):
+            return default
+
+        # The modification time tells which entries were used last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def set(self, key, value):
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            self.delete(key)
+            return
+
+        # Readers never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, self._path(key))
+
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        nb_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if nb_bytes <= self.max_bytes:
+                break
+
+            self._remove(path)
+            nb_bytes -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for path in self._paths():
+            self._remove(path)
+
+
+class ResultCache(object):
+    """Cache of the evaluations of FQuery objects
+
+    Entries are keyed by the index and the body of the search. They expire
+    after `ttl` seconds, if given, and are stored by the `backend`, in
+    memory by default. The flat lines are cached, unless `cache_response`
+    is True: the response of Elasticsearch is cached instead, and
+    flattened at each evaluation.
+    """
+
+    def __init__(self, backend=None, ttl=None, cache_response=False):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.cache_response = cache_response
+
+        self._serializer = JSONSerializer()
+
+    def make_key(self, search, **options):
+        data = {
+            'index': search._index,
+            'body': search.to_dict(),
+        }
+        # The same response gives different lines depending on the options
+        if not self.cache_response:
+            data['options'] = options
+
+        serialized = json.dumps(
+            data, sort_keys=True, default=self._serializer.default)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        data = self.backend.get(key)
+        if data is None:
+            return None
+
+        expires_at, value = pickle.loads(data)
+        if expires_at is not None and expires_at < time.time():
+            self.backend.delete(key)
+            return None
+
+        return value
+
+    def set(self, key, value):
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time.time() + self.ttl
+
+        # Values are pickled, each hit gets its own copy of the lines
+        self.backend.set(key, pickle.dumps(
+            (expires_at, value), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        self.backend.clear()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Elasticsearch types of the fields
+INTEGER_TYPES = ('long', 'integer', 'short', 'byte')
+FLOAT_TYPES = ('double', 'float')
+
+
+def _check_numpy():
+    if np is None:
+        raise ImportError(
+            'numpy is needed to get the result as columns, '
+            'you can install it with `pip install fiqs[numpy]`')
+
+
+def column_dtype(values, field_type=None):
+    # We only look at the non null values, the type of the field they
+    # come from is only used when there are none
+    if not values:
+        if field_type == 'date':
+            return 'datetime64[ms]'
+        if field_type in INTEGER_TYPES:
+            return 'int64'
+        if field_type in FLOAT_TYPES:
+            return 'float64'
+        return object
+
+    if all(isinstance(v, bool) for v in values):
+        return 'bool'
+
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return 'int64'
+
+    if all(
+            isinstance(v, (int, float)) and not isinstance(v, bool)
+            for v in values):
+        return 'float64'
+
+    if all(isinstance(v, datetime) for v in values):
+        return 'datetime64[ms]'
+
+    return object
+
+
+def _fill_value(dtype):
+    if dtype == 'bool':
+        return False
+    if dtype == 'int64':
+        return 0
+    if dtype == 'float64':
+        return np.nan
+    if dtype == 'datetime64[ms]':
+        return np.datetime64('NaT')
+    return None
+
+
+def _to_masked_array(values):
+    mask = [v is None for v in values]
+    dtype = column_dtype([v for v in values if v is not None])
+
+    fill_value = _fill_value(dtype)
+    data = np.array(
+        [fill_value if v is None else v for v in values],
+        dtype=dtype,
+    )
+
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def append_lines(columns, lines):
+    # Appends the values of the lines to the lists of values of each key
+    nb_lines = len(next(iter(columns.values()), []))
+
+    for line in lines:
+        for key, value in line.items():
+            if key not in columns:
+                columns[key] = [None] * nb_lines
+            columns[key].append(value)
+
+        nb_lines += 1
+
+        # Some keys may be missing from the line, e.g. in others lines
+        for values in columns.values():
+            if len(values) < nb_lines:
+                values.append(None)
+
+    return columns
+
+
+def lines_to_columns(lines):
+    """Transforms flat lines into a dictionary of numpy masked arrays
+
+    There is one array per key found in the lines, typed when possible.
+    Missing or None values are masked.
+    """
+    _check_numpy()
+
+    columns = append_lines(OrderedDict(), lines)
+
+    return OrderedDict(
+        (key, _to_masked_array(values))
+        for key, values in columns.items()
+    )
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from fiqs.aggregations import Avg
+from fiqs.columns import column_dtype
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+def _check_pandas():
+    if pd is None:
+        raise ImportError(
+            'pandas is needed to get the result as a dataframe, '
+            'you can install it with `pip install fiqs[pandas]`')
+
+
+def _field_type(field_or_exp):
+    # Type of the field the values come from, if any
+    if isinstance(field_or_exp, Avg):
+        # Average of an integer field does not have to be an integer
+        return 'double'
+
+    field = getattr(field_or_exp, 'field', field_or_exp)
+    return getattr(field, 'type', None)
+
+
+def _categories(choice_keys, values):
+    # Values outside of the choices, e.g. the others line, are kept
+    categories = []
+    seen = set()
+    for value in list(choice_keys) + values:
+        if value is None or value in seen:
+            continue
+        seen.add(value)
+        categories.append(value)
+
+    return categories
+
+
+def _to_series(values, field_type=None, choice_keys=None):
+    if choice_keys is not None:
+        return pd.Series(pd.Categorical(
+            values, categories=_categories(choice_keys, values)))
+
+    not_null_values = [v for v in values if v is not None]
+    dtype = column_dtype(not_null_values, field_type=field_type)
+
+    if not not_null_values or len(not_null_values) < len(values):
+        # Nullable types, the numpy ones cannot hold missing values
+        if dtype == 'int64':
+            dtype = 'Int64'
+        elif dtype == 'bool':
+            dtype = 'boolean'
+
+    return pd.Series(values, dtype=dtype)
+
+
+def columns_to_dataframe(columns, fields=None, choices=None):
+    """Transforms lists of values into a typed pandas dataframe
+
+    `columns` maps each key to its list of values. `fields` maps keys to
+    the fields or expressions their values come from, it is used to type
+    the columns without values. Keys in `choices` become categoricals,
+    with the given choice keys as categories.
+    """
+    _check_pandas()
+
+    fields = fields or {}
+    choices = choices or {}
+
+    return pd.DataFrame({
+        key: _to_series(
+            values,
+            field_type=_field_type(fields.get(key)),
+            choice_keys=choices.get(key),
+        )
+        for key, values in columns.items()
+    }, columns=list(columns.keys()))
@@ -5,6 +5,11 @@ from datetime import datetime
 
 from fiqs.i18n import _
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class Field(object):
     def __init__(self, type, key=None, verbose_name=None, storage_field=None,
@@ -84,6 +89,10 @@ class Field(object):
     def is_range(self):
         return 'ranges' in self.data
 
+    def has_all_buckets(self):
+        # See Aggregate.has_all_buckets, ranges are all returned
+        return self.is_range()
+
     def _has_pretty_choices(self):
         return self.choices and isinstance(self.choices[0], tuple)
 
@@ -155,6 +164,9 @@ class Field(object):
     def get_casted_value(self, v):
         return v
 
+    def get_casted_values(self, values):
+        return [self.get_casted_value(v) for v in values]
+
 
 class TextField(Field):
     def __init__(self, **kwargs):
@@ -174,6 +186,14 @@ class DateField(Field):
         # Careful, we lose the milliseconds here
         return datetime.utcfromtimestamp(v / 1000)
 
+    def get_casted_values(self, values):
+        # We convert all the timestamps at once if we can
+        if np is None or None in values:
+            return super(DateField, self).get_casted_values(values)
+
+        timestamps = np.array(values, dtype='int64')
+        return timestamps.astype('datetime64[ms]').tolist()
+
 
 class BaseIntegerField(Field):
     def __init__(self, **kwargs):
@@ -366,3 +386,6 @@ class GroupedField(Field):
             'filters': filters,
             'agg_type': 'filters',
         }
+
+    def has_all_buckets(self):
+        return True
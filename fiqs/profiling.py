@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from fiqs.tree import count_buckets
+
+# Phases of an evaluation, in the order they happen
+CONFIGURE_SEARCH = 'configure_search'
+EXECUTE = 'execute'
+FLATTEN = 'flatten'
+COMPUTED_FIELDS = 'computed_fields'
+CASTING = 'casting'
+MISSING_LINES = 'missing_lines'
+
+
+class EvalProfile(object):
+    """Measures of a single evaluation of a FQuery
+
+    Timings are exclusive: the time spent casting values while flattening
+    the result is counted in `casting`, not in `flatten`. The size of the
+    response is only estimated if `measure_response_size` is set, by
+    encoding it again in JSON.
+    """
+
+    enabled = True
+
+    def __init__(self, measure_response_size=False):
+        self.measure_response_size = measure_response_size
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+        self._phases = []
+        self._phase_start = None
+
+    def _charge_current_phase(self, now):
+        if self._phases:
+            name = self._phases[-1]
+            self.timings[name] = self.timings.get(name, 0.0) +\
+                now - self._phase_start
+        self._phase_start = now
+
+    @contextmanager
+    def phase(self, name):
+        self._charge_current_phase(time.perf_counter())
+        self._phases.append(name)
+        try:
+            yield
+        finally:
+            self._charge_current_phase(time.perf_counter())
+            self._phases.pop()
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def count_response(self, result):
+        es_result = getattr(result, '_d_', result)
+
+        if self.measure_response_size:
+            self.count('response_bytes_estimate',
+                       len(json.dumps(es_result, default=str)))
+        self.count('nb_buckets', count_buckets(es_result.get('aggregations')))
+        if 'took' in es_result:
+            self.count('elasticsearch_took_ms', es_result['took'])
+
+    @property
+    def total_time(self):
+        return sum(self.timings.values())
+
+    def __repr__(self):
+        return '<EvalProfile: {}, {}>'.format(
+            dict(self.timings), dict(self.counts))
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfile(object):
+    """Does not measure anything, used when no profiler is configured"""
+
+    enabled = False
+
+    # Phases may be entered once per line, it has to be cheap
+    _null_phase = _NullPhase()
+
+    def phase(self, name):
+        return self._null_phase
+
+    def count(self, name, value):
+        pass
+
+    def count_response(self, result):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+class Profiler(object):
+    """Receives the profile of each evaluation, does nothing by default"""
+
+    def __init__(self, measure_response_size=False):
+        self.measure_response_size = measure_response_size
+
+    def new_profile(self):
+        return EvalProfile(measure_response_size=self.measure_response_size)
+
+    def on_eval(self, fquery, profile):
+        pass
+
+
+class CallbackProfiler(Profiler):
+    def __init__(self, callback, measure_response_size=False):
+        super(CallbackProfiler, self).__init__(measure_response_size)
+        self.callback = callback
+
+    def on_eval(self, fquery, profile):
+        self.callback(fquery, profile)
+
+
+class RecordingProfiler(Profiler):
+    def __init__(self, measure_response_size=False):
+        super(RecordingProfiler, self).__init__(measure_response_size)
+        self.profiles = []
+
+    def on_eval(self, fquery, profile):
+        self.profiles.append(profile)
+
+
+_default_profiler = None
+
+
+def get_default_profiler():
+    return _default_profiler
+
+
+def set_default_profiler(profiler):
+    # Used by all the queries that were not given a profiler
+    global _default_profiler
+    _default_profiler = profiler
+
+
+@contextmanager
+def profile(fquery=None, measure_response_size=False):
+    """Records the profiles of the evaluations made in the block
+
+    Only the evaluations of `fquery` are recorded if it is given,
+    otherwise those of all the queries without a profiler.
+    """
+    profiler = RecordingProfiler(measure_response_size)
+
+    if fquery is not None:
+        previous_profiler = fquery.profiler
+        fquery.profiler = profiler
+    else:
+        previous_profiler = get_default_profiler()
+        set_default_profiler(profiler)
+
+    try:
+        yield profiler.profiles
+    finally:
+        if fquery is not None:
+            fquery.profiler = previous_profiler
+        else:
+            set_default_profiler(previous_profiler)
@@ -1,12 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import copy
+import functools
 from collections import OrderedDict
-from itertools import product
+from itertools import islice, product
 
-from fiqs import flatten_result
-from fiqs.aggregations import Aggregate, ReverseNested
+from elasticsearch_dsl import Search, connections
+
+from fiqs import iter_lines
+from fiqs.aggregations import Aggregate, DateRange, Histogram, ReverseNested
+from fiqs.cache import LRUCache
+from fiqs.columns import append_lines, lines_to_columns
+from fiqs.dataframes import _check_pandas, columns_to_dataframe
 from fiqs.exceptions import ConfigurationError
 from fiqs.fields import Field, GroupedField, NestedField
+from fiqs.profiling import (
+    CASTING,
+    COMPUTED_FIELDS,
+    CONFIGURE_SEARCH,
+    EXECUTE,
+    FLATTEN,
+    MISSING_LINES,
+    NULL_PROFILE,
+    get_default_profiler,
+)
+from fiqs.rows import make_row_class
+from fiqs.tree import (
+    BUCKET_LEVEL,
+    NESTED_LEVEL,
+    FlattenPlan,
+    ResultTree,
+    estimate_nb_buckets,
+)
+
+COMPOSITE_AGG_NAME = 'composite'
+
+EVAL_FORMATS = ('lines', 'columns', 'rows')
+
+# eval_async flattens the results having more buckets in an executor
+ASYNC_EXECUTOR_MIN_BUCKETS = 10000
+
+# Aggregations bodies, by query definition, shared by all the queries
+compiled_aggregations = LRUCache(max_entries=1024)
 
 
 def calc_group_by_keys(group_by_fields, nested=True):
@@ -25,8 +61,12 @@ def calc_group_by_keys(group_by_fields, nested=True):
 
 
 class FQuery(object):
-    def __init__(self, search, default_size=None):
+    def __init__(self, search, default_size=None, profiler=None, cache=None,
+                 dense_choices=False):
         self.search = search
+        self.profiler = profiler
+        self.cache = cache
+        self.dense_choices = dense_choices
 
         if default_size == 0:
             default_size = 2 ** 31 - 1
@@ -35,6 +75,9 @@ class FQuery(object):
         self._expressions = OrderedDict()
         self._group_by = []
         self._order_by = {}
+        self._plan = None
+        self._key_to_field = None
+        self._profile = NULL_PROFILE
 
     def values(self, *expressions, **named_expressions):
         # /!\ named_expressions may not be correctly ordered
@@ -47,6 +90,8 @@ class FQuery(object):
         self._expressions.update(exps)
 
         self._check_exps_for_computed_are_present()
+        self._plan = None
+        self._key_to_field = None
 
         return self
 
@@ -54,6 +99,8 @@ class FQuery(object):
         self._group_by += args
 
         self._check_nested_parents_are_present()
+        self._plan = None
+        self._key_to_field = None
 
         return self
 
@@ -63,7 +110,71 @@ class FQuery(object):
         return self
 
     def eval(self, flat=True, fill_missing_buckets=True,
-             add_others_line=False):
+             add_others_line=False, format='lines', limit=None, offset=0):
+        profiler = self.profiler or get_default_profiler()
+        if profiler is None:
+            return self._eval(
+                flat, fill_missing_buckets, add_others_line, format, limit,
+                offset)
+
+        self._profile = profiler.new_profile()
+        try:
+            ret = self._eval(
+                flat, fill_missing_buckets, add_others_line, format, limit,
+                offset)
+        finally:
+            profile, self._profile = self._profile, NULL_PROFILE
+
+        profiler.on_eval(self, profile)
+        return ret
+
+    async def eval_async(self, flat=True, fill_missing_buckets=True,
+                         add_others_line=False, format='lines', limit=None,
+                         offset=0, executor=None):
+        # Same as eval, through the asynchronous client of the search.
+        # Large results are flattened in the executor, not to block the loop.
+        search = self._configure_eval_search(
+            flat, add_others_line, format, limit, offset)
+
+        cache_key = self._get_cache_key(
+            search, flat, fill_missing_buckets, add_others_line, format,
+            limit, offset)
+        cached = self._get_cached(cache_key)
+
+        if cached is not None and self._caches_lines(flat):
+            return cached
+        elif cached is not None:
+            es_result = cached
+        else:
+            es = connections.get_connection(search._using)
+            es_result = await es.search(
+                index=search._index,
+                doc_type=search._get_doc_type(),
+                body=search.to_dict(),
+                **search._params
+            )
+            self._cache_response(cache_key, flat, es_result)
+
+        result = search._response_class(search, es_result)
+        args = (result, flat, fill_missing_buckets, add_others_line, format,
+                limit, offset)
+
+        # The buckets are estimated, counting them would block the loop too
+        if estimate_nb_buckets(es_result.get('aggregations'))\
+                < ASYNC_EXECUTOR_MIN_BUCKETS:
+            ret = self._eval_result(*args)
+        else:
+            loop = asyncio.get_running_loop()
+            ret = await loop.run_in_executor(
+                executor, functools.partial(self._eval_result, *args))
+
+        self._cache_lines(cache_key, flat, ret)
+        return ret
+
+    def _configure_eval_search(self, flat, add_others_line, format, limit,
+                               offset):
+        if format not in EVAL_FORMATS:
+            raise ConfigurationError(u'Unknown format: {}'.format(format))
 
         # Raise if computed fields are present, and we are not in flat mode
         if not flat:
@@ -72,22 +183,186 @@ class FQuery(object):
                     raise ConfigurationError(
                         u'Cannot use computed fields in non-flat mode')
 
-        search = self._configure_search()
-        result = search.execute()
+        # We may ask Elasticsearch for the first lines only
+        # The others line depends on the buckets we did not ask for
+        max_size = None
+        if flat and limit is not None and not add_others_line:
+            max_size = offset + limit
+
+        return self._configure_search(max_size=max_size, typed_aggs=not flat)
+
+    def _caches_lines(self, flat):
+        # Either the lines or the response are cached
+        return self.cache is not None and flat\
+            and not self.cache.cache_response
+
+    def _get_cached(self, cache_key):
+        # Either the lines or the response, see _caches_lines
+        if cache_key is None:
+            return None
+        return self.cache.get(cache_key)
+
+    def _cache_response(self, cache_key, flat, es_result):
+        if cache_key is not None and not self._caches_lines(flat):
+            self.cache.set(cache_key, es_result)
+
+    def _cache_lines(self, cache_key, flat, lines):
+        if cache_key is not None and self._caches_lines(flat):
+            self.cache.set(cache_key, lines)
+
+    def _get_cache_key(self, search, flat, fill_missing_buckets,
+                       add_others_line, format, limit, offset):
+        if self.cache is None:
+            return None
+
+        return self.cache.make_key(
+            search,
+            definition=self._get_lines_definition(),
+            flat=flat,
+            fill_missing_buckets=fill_missing_buckets,
+            add_others_line=add_others_line,
+            format=format,
+            limit=limit,
+            offset=offset,
+        )
 
-        if flat:
-            lines = self._flatten_result(
-                result,
-                add_others_line=add_others_line,
-                remove_nested_aggregations=self._contains_nested_expressions(),
-            )
+    def _eval(self, flat, fill_missing_buckets, add_others_line, format,
+              limit, offset):
+        profile = self._profile
+
+        with profile.phase(CONFIGURE_SEARCH):
+            search = self._configure_eval_search(
+                flat, add_others_line, format, limit, offset)
+
+        cache_key = self._get_cache_key(
+            search, flat, fill_missing_buckets, add_others_line, format,
+            limit, offset)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            profile.count('cache_hits', 1)
+            if self._caches_lines(flat):
+                return cached
+
+            result = search._response_class(search, cached)
+            return self._eval_result(
+                result, flat, fill_missing_buckets, add_others_line,
+                format, limit, offset)
+
+        with profile.phase(EXECUTE):
+            result = search.execute()
+        profile.count_response(result)
+
+        self._cache_response(cache_key, flat, result.to_dict())
+
+        ret = self._eval_result(
+            result, flat, fill_missing_buckets, add_others_line, format,
+            limit, offset)
+
+        self._cache_lines(cache_key, flat, ret)
+        return ret
+
+    def _eval_result(self, result, flat, fill_missing_buckets,
+                     add_others_line, format, limit, offset):
+        profile = self._profile
+
+        if not flat:
+            return result
+
+        if format == 'lines' and limit is None and not offset:
+            # The whole result is needed, it is flattened at once
+            with profile.phase(FLATTEN):
+                lines = self._flatten_result(
+                    result,
+                    add_others_line=add_others_line,
+                    remove_nested_aggregations=(
+                        self._contains_nested_expressions()),
+                )
 
             if fill_missing_buckets:
                 lines = self._add_missing_lines(lines)
 
-            return lines
+            ret = lines
         else:
-            return result
+            lines = self._iter_lines(
+                result, fill_missing_buckets, add_others_line)
+
+            # Lines are flattened until we have enough of them,
+            # missing buckets come last and may not be needed
+            if limit is not None or offset:
+                stop = offset + limit if limit is not None else None
+                lines = islice(lines, offset, stop)
+
+            with profile.phase(FLATTEN):
+                if format == 'columns':
+                    ret = lines_to_columns(lines)
+                elif format == 'rows':
+                    row_class = self._get_row_class()
+                    ret = [row_class.from_line(line) for line in lines]
+                else:
+                    ret = list(lines)
+
+        if format == 'columns':
+            nb_lines = len(next(iter(ret.values()), []))
+        else:
+            nb_lines = len(ret)
+        profile.count('nb_lines', nb_lines)
+
+        return ret
+
+    def to_dataframe(self, fill_missing_buckets=True, add_others_line=False):
+        # The columns are built as the result is flattened,
+        # we never hold the whole result as lines
+        _check_pandas()
+
+        search = self._configure_search()
+        result = search.execute()
+
+        # Computed fields need the lines
+        columns = None
+        if not add_others_line and not any(
+                exp.is_computed() for exp in self._expressions.values()):
+            columns = self._single_level_columns(result)
+
+        if columns is None:
+            lines = self._iter_lines(
+                result, fill_missing_buckets, add_others_line)
+            columns = append_lines(OrderedDict(), lines)
+
+        elif fill_missing_buckets:
+            group_by_keys = self._group_by_keys(nested=False)
+            lines = [
+                dict(zip(group_by_keys, values))
+                for values in zip(*[columns[key] for key in group_by_keys])
+            ]
+            append_lines(columns, self._get_missing_lines(lines))
+
+        return columns_to_dataframe(
+            columns,
+            fields=self._get_key_to_field(),
+            choices=self._get_group_by_choices(),
+        )
+
+    def iter_eval(self, fill_missing_buckets=True, add_others_line=False):
+        # Lines are yielded as soon as they are flattened.
+        # Missing buckets, if any, are yielded last.
+        search = self._configure_search()
+        result = search.execute()
+
+        return self._iter_lines(result, fill_missing_buckets, add_others_line)
+
+    def iter_composite(self, page_size=1000, fill_missing_buckets=True):
+        # The group by is made with a single composite aggregation, which
+        # we page through. Lines are yielded one page at a time.
+        sources = self._composite_sources()
+        lines = self._iter_pretty_lines(
+            self._iter_composite_lines(sources, page_size))
+
+        if fill_missing_buckets:
+            # Composite aggregations do not return empty buckets
+            lines = self._iter_with_missing_lines(
+                lines, with_empty_buckets=False)
+
+        return lines
 
     ################
     # Internal API #
@@ -143,14 +418,125 @@ class FQuery(object):
             for idx in indices:
                 self._group_by.insert(idx, nested_fields_to_add[idx])
 
-    def _configure_search(self):
-        agg = self._configure_aggregations()
+    def _configure_search(self, max_size=None, typed_aggs=False):
+        # We work on a copy of the search, the query can be evaluated again
+        aggs = self._compile_aggregations(max_size=max_size)
+        if not aggs:
+            return self.search._clone()
+
+        if self.search.aggs.aggs:
+            # Aggregations added to the search beforehand are kept
+            aggs = dict(self.search.aggs.to_dict()['aggs'], **aggs)
+
+        if typed_aggs:
+            # elasticsearch-dsl needs its aggregation objects
+            # to wrap the aggregations of the response
+            search = self.search._clone()
+            search.update_from_dict({'aggs': aggs})
+            return search
+
+        return self.search.extra(aggs=aggs)
+
+    def _compile_aggregations(self, max_size=None):
+        # We only build the elasticsearch-dsl objects once by definition
+        key = repr((
+            self._get_group_by_definition(),
+            self._order_by,
+            self.default_size,
+            max_size,
+            self.dense_choices,
+            self._get_values_definition(),
+        ))
+
+        aggs = compiled_aggregations.get(key)
+        if aggs is not None:
+            # The compiled aggregations are shared, each search gets its copy
+            return copy.deepcopy(aggs)
+
+        current_agg = Search().aggs
+        agg = current_agg
+        for params in self._get_aggregations_params(max_size=max_size):
+            agg = agg.bucket(**params)
         self._configure_values(agg)
 
-        return self.search
+        aggs = current_agg.to_dict().get('aggs', {})
+        compiled_aggregations.set(key, copy.deepcopy(aggs))
+        return aggs
+
+    def _get_lines_definition(self):
+        # Everything the lines depend on besides the response, e.g. the
+        # computed fields, which are not in the body of the search
+        return repr((
+            [
+                (key, expression.__class__.__name__, str(expression))
+                for key, expression in self._expressions.items()
+            ],
+            self._get_values_definition(),
+            self._get_group_by_definition(),
+            self.dense_choices,
+        ))
+
+    def _get_group_by_definition(self):
+        # Everything _get_aggregations_params relies on
+        definition = []
+
+        for field_or_exp in self._group_by:
+            if isinstance(field_or_exp, Aggregate):
+                definition.append((
+                    field_or_exp.__class__.__name__,
+                    field_or_exp.reference(),
+                    field_or_exp.field.key,
+                    field_or_exp.field.get_storage_field(),
+                    field_or_exp.params,
+                ))
 
-    def _configure_aggregations(self):
-        current_agg = self.search.aggs
+            else:
+                definition.append((
+                    field_or_exp.__class__.__name__,
+                    field_or_exp.key,
+                    field_or_exp.get_storage_field(),
+                    field_or_exp.type,
+                    field_or_exp.choices,
+                    field_or_exp.data,
+                    getattr(field_or_exp, 'groups', None),
+                ))
+
+        return definition
+
+    def _get_values_definition(self):
+        # Everything _configure_values relies on
+        definition = []
+
+        for key, expression in self._expressions.items():
+            if isinstance(expression, ReverseNested):
+                definition.append((
+                    key,
+                    expression.reverse_agg_params(),
+                    [
+                        (
+                            nested_key,
+                            str(nested_expression),
+                            nested_expression.field.get_storage_field(),
+                            nested_expression.params,
+                        )
+                        for nested_key, nested_expression
+                        in expression._expressions.items()
+                        if nested_expression.is_field_agg()
+                    ],
+                ))
+
+            elif expression.is_field_agg():
+                definition.append((
+                    key,
+                    str(expression),
+                    expression.field.get_storage_field(),
+                    expression.params,
+                ))
+
+        return definition
+
+    def _get_aggregations_params(self, max_size=None):
+        aggregations_params = []
         last_idx = len(self._group_by) - 1
 
         for idx, field_or_exp in enumerate(self._group_by):
@@ -169,6 +555,21 @@ class FQuery(object):
                         and self.default_size:
                     params.setdefault('size', self.default_size)
 
+                if self._has_dense_choices(field_or_exp):
+                    # Elasticsearch returns a bucket for each choice, even
+                    # empty, and no bucket for the other values
+                    choice_keys = list(field_or_exp.choice_keys())
+                    params['include'] = choice_keys
+                    params['min_doc_count'] = 0
+                    params['size'] = max(
+                        params.get('size', 0), len(choice_keys))
+
+                # With a single level of buckets, each bucket is a line.
+                # We do not ask for more buckets than the lines we need.
+                if max_size is not None and len(self._group_by) == 1\
+                        and 'size' in params and max_size < params['size']:
+                    params['size'] = max_size
+
             else:
                 raise NotImplementedError
 
@@ -183,9 +584,88 @@ class FQuery(object):
                     elif self._order_by.keys() == ['_count']:
                         params['order'] = self._order_by
 
-            current_agg = current_agg.bucket(**params)
+            aggregations_params.append(params)
+
+        return aggregations_params
+
+    def _composite_sources(self):
+        sources = []
+
+        for field_or_exp in self._group_by:
+            if isinstance(field_or_exp, DateRange)\
+                    or isinstance(field_or_exp, NestedField)\
+                    or isinstance(field_or_exp, GroupedField)\
+                    or (isinstance(field_or_exp, Field)
+                        and field_or_exp.is_range()):
+                raise ConfigurationError(
+                    u'Cannot group by {} in composite mode'.format(
+                        field_or_exp))
+
+            if isinstance(field_or_exp, Histogram):
+                # Extended bounds are not supported
+                params = {
+                    key: value
+                    for key, value in field_or_exp.params.items()
+                    if key not in ('min', 'max')
+                }
+                params['field'] = field_or_exp.field.get_storage_field()
+                source = {field_or_exp.reference(): params}
+                key = field_or_exp.field.key
+
+            elif isinstance(field_or_exp, Field):
+                params = field_or_exp.bucket_params()
+                source = {
+                    'terms': {
+                        key: params[key]
+                        for key in ('field', 'script') if key in params
+                    },
+                }
+                key = field_or_exp.key
+
+            else:
+                raise NotImplementedError
+
+            sources.append({key: source})
+
+        return sources
+
+    def _configure_composite_search(self, sources, page_size, after_key=None):
+        # We work on a copy of the search, hits are useless here
+        search = self.search[:0]
 
-        return current_agg
+        params = {
+            'sources': sources,
+            'size': page_size,
+        }
+        if after_key is not None:
+            params['after'] = after_key
+
+        agg = search.aggs.bucket(COMPOSITE_AGG_NAME, 'composite', **params)
+        self._configure_values(agg)
+
+        return search
+
+    def _iter_composite_lines(self, sources, page_size):
+        tree = ResultTree({})
+        after_key = None
+
+        while True:
+            search = self._configure_composite_search(
+                sources, page_size, after_key)
+            es_result = ResultTree(search.execute()).es_result
+
+            node = es_result.get('aggregations', {}).get(COMPOSITE_AGG_NAME)
+            buckets = node['buckets'] if node else []
+
+            for bucket in buckets:
+                # The keys of the bucket are the base of its line
+                yield tree._create_line(bucket['key'], bucket)
+
+            if len(buckets) < page_size:
+                return
+
+            # Elasticsearch < 6.3 does not give the after key
+            after_key = node.get('after_key', buckets[-1]['key'])
 
     def _configure_values(self, agg):
         for key, expression in self._expressions.items():
@@ -202,7 +682,135 @@ class FQuery(object):
                 )
 
     def _flatten_result(self, result, **kwargs):
-        lines = flatten_result(result, **kwargs)
+        if not kwargs.get('add_others_line'):
+            lines = self._flatten_single_level(result)
+            if lines is not None:
+                return lines
+
+        return list(self._iter_flatten_result(result, **kwargs))
+
+    def _flatten_single_level(self, result):
+        columns = self._single_level_columns(result)
+        if columns is None:
+            return None
+
+        keys = list(columns.keys())
+        lines = [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+        if any(exp.is_computed() for exp in self._expressions.values()):
+            with self._profile.phase(COMPUTED_FIELDS):
+                for line in lines:
+                    self._add_computed_results(line)
+
+        return lines
+
+    def _single_level_columns(self, result):
+        # Fast path for our most common shape: a single list of buckets,
+        # e.g. a date histogram, with metrics directly in the buckets.
+        # Returns None if the query or the result do not have this shape.
+        plan = self._get_flatten_plan()
+        if len(plan.levels) != 1 or plan.reverse_nested:
+            return None
+
+        field_or_exp = self._group_by[0]
+        if isinstance(field_or_exp, GroupedField):
+            return None
+        if isinstance(field_or_exp, Field) and field_or_exp.is_range():
+            return None
+
+        tree = ResultTree(result)
+        if 'aggregations' not in tree.es_result:
+            return None
+
+        # The plan does not match either if the search had other
+        # aggregations, their lines are not dropped
+        aggregations = tree.es_result['aggregations']
+        if not tree._plan_matches(aggregations, plan):
+            return None
+
+        _, key = plan.levels[0]
+        buckets = aggregations[key]['buckets']
+        if not isinstance(buckets, list):
+            return None
+
+        # We extract and cast each column at once
+        key_to_field = self._get_key_to_field()
+        columns = OrderedDict()
+        columns[key] = [bucket['key'] for bucket in buckets]
+        columns['doc_count'] = [bucket['doc_count'] for bucket in buckets]
+        for metric_key in plan.metric_keys:
+            columns[metric_key] = [
+                bucket[metric_key]['value'] for bucket in buckets]
+
+        with self._profile.phase(CASTING):
+            for column_key in [key] + plan.metric_keys:
+                columns[column_key] = key_to_field[
+                    column_key].get_casted_values(columns[column_key])
+
+        return columns
+
+    def _get_flatten_plan(self):
+        # The plan only depends on the query definition, we compute it once
+        if self._plan is not None:
+            return self._plan
+
+        levels = []
+        for field_or_exp in self._group_by:
+            if isinstance(field_or_exp, NestedField):
+                levels.append((NESTED_LEVEL, field_or_exp.key))
+            elif isinstance(field_or_exp, Aggregate):
+                levels.append((BUCKET_LEVEL, field_or_exp.field.key))
+            else:
+                levels.append((BUCKET_LEVEL, field_or_exp.key))
+
+        metric_keys = []
+        reverse_nested = OrderedDict()
+        for key, expression in self._expressions.items():
+            if isinstance(expression, ReverseNested):
+                name = expression.reverse_agg_params()['name']
+                reverse_nested[name] = [
+                    nested_key
+                    for nested_key, nested_expression
+                    in expression._expressions.items()
+                    if nested_expression.is_field_agg()
+                ]
+            elif expression.is_field_agg():
+                metric_keys.append(key)
+
+        self._plan = FlattenPlan(levels, metric_keys, reverse_nested)
+        return self._plan
+
+    def _get_row_class(self):
+        columns = self._group_by_keys(nested=False)
+        columns += [
+            key for key in self._create_empty_line({}).keys()
+            if key not in columns
+        ]
+
+        return make_row_class(columns)
+
+    def _get_group_by_choices(self):
+        # Group by keys whose values are known in advance
+        choices = {}
+
+        for field_or_exp in self._group_by:
+            if isinstance(field_or_exp, DateRange):
+                choices[field_or_exp.field.key] = field_or_exp.choice_keys()
+
+            elif isinstance(field_or_exp, Aggregate)\
+                    or isinstance(field_or_exp, NestedField)\
+                    or not isinstance(field_or_exp, Field):
+                continue
+
+            elif field_or_exp.choices or field_or_exp.is_range():
+                choices[field_or_exp.key] = field_or_exp.choice_keys()
+
+        return choices
+
+    def _get_key_to_field(self):
+        # The mapping only depends on the query definition, like the plan
+        if self._key_to_field is not None:
+            return self._key_to_field
 
         key_to_field = {}
         for key, exp in self._expressions.items():
@@ -222,20 +830,43 @@ class FQuery(object):
             else:
                 key_to_field[field_or_exp.key] = field_or_exp
 
-        pretty_lines = []
+        self._key_to_field = key_to_field
+        return self._key_to_field
+
+    def _iter_lines(self, result, fill_missing_buckets, add_others_line):
+        # Flat lines of the result, then the missing ones
+        lines = self._iter_flatten_result(
+            result,
+            add_others_line=add_others_line,
+            remove_nested_aggregations=self._contains_nested_expressions(),
+        )
+
+        if fill_missing_buckets:
+            lines = self._iter_with_missing_lines(lines)
+
+        return lines
+
+    def _iter_flatten_result(self, result, **kwargs):
+        kwargs.setdefault('plan', self._get_flatten_plan())
+        return self._iter_pretty_lines(iter_lines(result, **kwargs))
+
+    def _iter_pretty_lines(self, lines):
+        key_to_field = self._get_key_to_field()
+        profile = self._profile
+
         for line in lines:
-            pretty_line = line.copy()
-            self._add_computed_results(pretty_line)
-
-            others_line = False
-            for key, value in pretty_line.items():
-                if key in key_to_field:
-                    field = key_to_field[key]
-                    if value == u'others':
-                        pretty_line[key] = value  # add_others_line mode
-                        others_line = True
-                    else:
-                        pretty_line[key] = field.get_casted_value(value)
+            # Lines are not shared, we can update them in place
+            pretty_line = line
+
+            # Entering the phases has a cost, we skip it when not profiling
+            if profile.enabled:
+                with profile.phase(COMPUTED_FIELDS):
+                    self._add_computed_results(pretty_line)
+                with profile.phase(CASTING):
+                    others_line = self._cast_line(pretty_line, key_to_field)
+            else:
+                self._add_computed_results(pretty_line)
+                others_line = self._cast_line(pretty_line, key_to_field)
 
             if others_line:
                 # We make sure all metrics are present
@@ -243,9 +874,21 @@ class FQuery(object):
                     if key not in pretty_line:
                         pretty_line[key] = None
 
-            pretty_lines.append(pretty_line)
+            yield pretty_line
+
+    def _cast_line(self, line, key_to_field):
+        # Returns whether the line is an others line
+        others_line = False
+        for key, value in line.items():
+            if key in key_to_field:
+                field = key_to_field[key]
+                if value == u'others':
+                    line[key] = value  # add_others_line mode
+                    others_line = True
+                else:
+                    line[key] = field.get_casted_value(value)
 
-        return pretty_lines
+        return others_line
 
     def _add_computed_results(self, line):
         computed_expressions = []
@@ -273,35 +916,147 @@ class FQuery(object):
                     pass
 
     def _add_missing_lines(self, lines):
-        enums = self._get_field_enums(lines)
+        with self._profile.phase(MISSING_LINES):
+            missing_lines = self._get_missing_lines(lines)
+        self._profile.count('nb_missing_lines', len(missing_lines))
 
-        keys = list(product(*enums)) if enums else []
-        if len(keys) == len(lines):
-            return lines
+        lines += missing_lines
+        return lines
 
+    def _iter_with_missing_lines(self, lines, with_empty_buckets=True):
+        # We only keep the group by keys of the lines we yielded
         group_by_keys_without_nested = self._group_by_keys(nested=False)
-        # We cast everything as str for easier matching
-        # it won't change the type of keys in lines
-        treated_hashes = [
-            u','.join(
-                [str(line[key]) for key in group_by_keys_without_nested])
+        existing_keys = set()
+        nb_lines = 0
+
+        for line in lines:
+            existing_keys.add(tuple(
+                line[key] for key in group_by_keys_without_nested))
+            nb_lines += 1
+            yield line
+
+        missing_lines = self._iter_missing_lines(
+            existing_keys, nb_lines, group_by_keys_without_nested,
+            with_empty_buckets=with_empty_buckets)
+
+        profile = self._profile
+        if not profile.enabled:
+            for line in missing_lines:
+                yield line
+            return
+
+        nb_missing_lines = 0
+        while True:
+            with profile.phase(MISSING_LINES):
+                line = next(missing_lines, None)
+            if line is None:
+                break
+
+            nb_missing_lines += 1
+            yield line
+
+        profile.count('nb_missing_lines', nb_missing_lines)
+
+    def _get_missing_lines(self, lines):
+        group_by_keys_without_nested = self._group_by_keys(nested=False)
+        existing_keys = set(
+            tuple(line[key] for key in group_by_keys_without_nested)
             for line in lines
+        )
+
+        return list(self._iter_missing_lines(
+            existing_keys, len(lines), group_by_keys_without_nested))
+
+    def _iter_missing_lines(self, existing_keys, nb_lines, group_by_keys,
+                            with_empty_buckets=True):
+        # Only the existing keys and their prefixes are kept in memory,
+        # the product of the enums is never built
+        enums = self._get_field_enums(existing_keys)
+        if not enums:
+            return
+
+        nb_keys = 1
+        for enum in enums:
+            nb_keys *= len(enum)
+        if nb_keys == nb_lines:
+            return
+
+        # The prefixes of the existing keys, by length
+        existing_prefixes = [
+            set(key[:length] for key in existing_keys)
+            for length in range(1, len(enums))
         ]
-        treated_hashes = set(treated_hashes)
-        missing_keys = [
-            key
-            for key in keys
-            if u','.join([str(k) for k in key]) not in treated_hashes
-        ]
+        existing_prefixes.append(existing_keys)
 
-        lines += self._create_missing_lines(
-            missing_keys,
-            group_by_keys_without_nested,
-        )
+        if with_empty_buckets:
+            complete_levels = self._get_complete_levels(
+                enums, existing_prefixes)
+        else:
+            complete_levels = [False] * len(enums)
 
-        return lines
+        for idx, is_complete in enumerate(complete_levels):
+            # The keys of Elasticsearch may not be those we expect,
+            # e.g. with a time zone
+            if is_complete:
+                enums[idx] = sorted(set(key[idx] for key in existing_keys))
 
-    def _get_field_enums(self, lines):
+        missing_keys = self._iter_missing_keys(
+            (), enums, complete_levels, existing_prefixes)
+        for missing_key in missing_keys:
+            yield self._create_missing_line(missing_key, group_by_keys)
+
+    def _get_complete_levels(self, enums, existing_prefixes):
+        # Elasticsearch returns the same keys, e.g. all the buckets between
+        # the bounds of a histogram, under each bucket of the previous level.
+        # If there are as many as we expect, none of them is missing.
+        # Otherwise, e.g. if the bounds of the response are not those of the
+        # query, the missing lines are found by the client.
+        complete_levels = []
+        nb_parents = 1
+
+        for idx, has_all_buckets in enumerate(
+                self._get_levels_with_all_buckets()):
+            nb_prefixes = len(existing_prefixes[idx])
+            complete_levels.append(
+                has_all_buckets and nb_prefixes == nb_parents * len(enums[idx]))
+            nb_parents = nb_prefixes
+
+        return complete_levels
+
+    def _iter_missing_keys(self, prefix, enums, complete_levels,
+                           existing_prefixes):
+        depth = len(prefix)
+
+        # Nothing is missing below an existing prefix
+        # if all the next levels are complete
+        if all(complete_levels[depth:]):
+            return
+
+        for value in enums[depth]:
+            key = prefix + (value,)
+            if key in existing_prefixes[depth]:
+                for missing_key in self._iter_missing_keys(
+                        key, enums, complete_levels, existing_prefixes):
+                    yield missing_key
+            else:
+                # All the keys starting with this one are missing
+                for end in product(*enums[depth + 1:]):
+                    yield key + end
+
+    def _get_levels_with_all_buckets(self):
+        return [
+            field.has_all_buckets() or self._has_dense_choices(field)
+            for field in self._group_by
+            if not isinstance(field, (NestedField, ReverseNested))
+        ]
+
+    def _has_dense_choices(self, field):
+        # Terms aggregations only, other buckets are not filtered by value
+        return self.dense_choices and isinstance(field, Field)\
+            and not isinstance(field, (GroupedField, NestedField))\
+            and not field.is_range() and bool(field.choices)
+
+    def _get_field_enums(self, existing_keys):
         enums = []
 
         for field in self._group_by:
@@ -309,6 +1064,9 @@ class FQuery(object):
                     or isinstance(field, ReverseNested):
                 continue
 
+            # Position of the field in the keys
+            idx = len(enums)
+
             if isinstance(field, Aggregate):
                 if field.choice_keys():
                     enums.append(field.choice_keys())
@@ -316,8 +1074,7 @@ class FQuery(object):
                     enums.append(field.field.choice_keys())
                 else:
                     # We just add the lines' values
-                    key = field.field.key
-                    values = set([line[key] for line in lines])
+                    values = set([key[idx] for key in existing_keys])
                     values = sorted(list(values))
                     enums.append(values)
 
@@ -330,8 +1087,7 @@ class FQuery(object):
 
                 else:
                     # We add the lines' values
-                    key = field.key
-                    values = set([line[key] for line in lines])
+                    values = set([key[idx] for key in existing_keys])
                     values = sorted(list(values))
                     enums.append(values)
 
@@ -340,21 +1096,15 @@ class FQuery(object):
     def _group_by_keys(self, nested=True):
         return calc_group_by_keys(self._group_by, nested)
 
-    def _create_missing_lines(self, missing_keys, group_by_keys):
-        lines = []
+    def _create_missing_line(self, missing_key, group_by_keys):
+        base_line = {}
+        for idx, group_by_key in enumerate(group_by_keys):
+            value = missing_key[idx]
+            if hasattr(value, 'original_value'):  # In case of Choices
+                value = value.original_value
+            base_line[group_by_key] = value
 
-        for missing_key in missing_keys:
-            base_line = {}
-            for idx, group_by_key in enumerate(group_by_keys):
-                current_key = group_by_keys[idx]
-                value = missing_key[idx]
-                if hasattr(value, 'original_value'):  # In case of Choices
-                    value = value.original_value
-                base_line[current_key] = value
-
-            lines.append(self._create_empty_line(base_line))
-
-        return lines
+        return self._create_empty_line(base_line)
 
     def _create_empty_line(self, base_line):
         empty_line = base_line.copy()
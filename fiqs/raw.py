@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+from fiqs.exceptions import ConfigurationError
+from fiqs.tree import ResultTree
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Lines are streamed, there is no output, workers, plan or engine to choose
+RAW_ARGUMENTS = ('add_others_line', 'remove_nested_aggregations')
+
+
+def _check_ijson():
+    if ijson is None:
+        raise ImportError(
+            'ijson is needed to flatten raw results, '
+            'you can install it with `pip install fiqs[ijson]`')
+
+
+class RawResultTree(ResultTree):
+    """Flattens the raw bytes of an Elasticsearch response
+
+    The response is read with an incremental JSON parser, and buckets are
+    flattened, then dropped, as soon as they are closed. Only the buckets
+    being read, and their ancestors, are kept in memory. Keyed buckets are
+    kept until their parent bucket is closed, to be flattened in the order
+    of their keys, like `flatten_result` does.
+    """
+
+    def __init__(self, raw_result):
+        super(RawResultTree, self).__init__({})
+
+        if isinstance(raw_result, str):
+            raw_result = raw_result.encode('utf-8')
+        if isinstance(raw_result, bytes):
+            raw_result = io.BytesIO(raw_result)
+
+        self.raw_result = raw_result
+
+    def iter_lines(self, **kwargs):
+        _check_ijson()
+
+        for key in kwargs:
+            if key not in RAW_ARGUMENTS:
+                raise ConfigurationError(
+                    u'Unsupported argument: {}'.format(key))
+
+        self.add_others_line = kwargs.get('add_others_line', False)
+        self.remove_nested_aggregations = kwargs.get(
+            'remove_nested_aggregations', True)
+
+        events = ijson.basic_parse(self.raw_result, use_float=True)
+        return self._walk_raw_lines(events)
+
+    def _is_bucket(self, frames, idx):
+        # A bucket is a dict found in the `buckets` of an aggregation
+        return idx >= 3 and frames[idx - 1][1] == 'buckets'\
+            and isinstance(frames[idx][0], dict)
+
+    def _raw_base_line(self, frames):
+        # Returns None if a key of the branch is still unknown
+        base_line = {}
+        parent_bucket_idx = 0
+
+        for idx in range(len(frames)):
+            if not self._is_bucket(frames, idx):
+                continue
+
+            # We only go through nested aggregations if we remove them
+            if idx - 2 != parent_bucket_idx + 1\
+                    and not self.remove_nested_aggregations:
+                return None
+            parent_bucket_idx = idx
+
+            bucket = frames[idx][0]
+            if isinstance(frames[idx - 1][0], dict):
+                # Keyed buckets are flattened in the order of their keys,
+                # once we have all of them
+                return None
+            if 'key' not in bucket:
+                return None
+
+            base_line[frames[idx - 2][1]] = bucket['key']
+
+        return base_line
+
+    def _raw_others_line(self, frames):
+        # Elasticsearch gives the count of the other buckets before the
+        # buckets, the others line comes first, like in `flatten_result`
+        node, key, _ = frames[-1]
+        if 'sum_other_doc_count' not in node:
+            return None
+
+        base_line = self._raw_base_line(frames)
+        if base_line is None:
+            return None
+
+        last_bucket_idx = 0
+        for idx in range(len(frames)):
+            if self._is_bucket(frames, idx):
+                last_bucket_idx = idx
+        if len(frames) - 1 != last_bucket_idx + 1\
+                and not self.remove_nested_aggregations:
+            return None
+
+        return self._create_others_line(
+            base_line, key, node.pop('sum_other_doc_count'))
+
+    def _walk_raw_lines(self, events):
+        aggregations = None
+        depth = 0
+        root_key = None
+
+        # Each frame holds a container of the aggregations being read,
+        # its key in its parent, and its current key if it is a dict
+        frames = []
+
+        for event, value in events:
+            if not frames:
+                # We are outside of the aggregations, we skip everything
+                if event == 'map_key' and depth == 1:
+                    root_key = value
+                elif event == 'start_map' and depth == 1\
+                        and root_key == 'aggregations':
+                    aggregations = {}
+                    frames.append([aggregations, None, None])
+                elif event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                continue
+
+            if event == 'map_key':
+                frames[-1][2] = value
+                continue
+
+            if event in ('end_map', 'end_array'):
+                base_line = None
+                if self._is_bucket(frames, len(frames) - 1):
+                    base_line = self._raw_base_line(frames)
+                frame = frames.pop()
+
+                if len(frames) == 0:
+                    # We are done with the aggregations, we flatten
+                    # whatever is left, e.g. others lines or metrics
+                    if aggregations:
+                        for line in self._walk_lines(aggregations):
+                            yield line
+                    return
+
+                if base_line is None:
+                    continue
+
+                # The whole branch is known, we flatten the bucket now
+                bucket = frame[0]
+                for line in self._walk_bucket(
+                        base_line, self._nested_view(bucket)):
+                    yield line
+
+                parent = frames[-1][0]
+                if isinstance(parent, list):
+                    parent.pop()
+                else:
+                    del parent[frame[1]]
+                continue
+
+            if event == 'start_map':
+                value = {}
+            elif event == 'start_array':
+                value = []
+
+            parent, _, parent_key = frames[-1]
+            if event == 'start_array' and parent_key == 'buckets'\
+                    and self.add_others_line and isinstance(parent, dict):
+                others_line = self._raw_others_line(frames)
+                if others_line is not None:
+                    yield others_line
+
+            if isinstance(parent, list):
+                parent.append(value)
+            else:
+                parent[parent_key] = value
+
+            if event in ('start_map', 'start_array'):
+                frames.append([value, parent_key, None])
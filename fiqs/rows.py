@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class Row(Mapping):
+    """Read-only flat line, sharing its keys with the other rows
+
+    Each row only holds a tuple of values. The keys, and their position in
+    the tuple, are stored once on the row class.
+    """
+
+    __slots__ = ('_values',)
+
+    _columns = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = tuple(values)
+
+    @classmethod
+    def from_line(cls, line):
+        return cls(line.get(column) for column in cls._columns)
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, dict(self))
+
+    def __reduce__(self):
+        return (_rebuild_row, (self._columns, self._values))
+
+
+def _rebuild_row(columns, values):
+    return make_row_class(columns)(values)
+
+
+# Row classes are shared between queries having the same columns
+_row_classes = {}
+
+
+def make_row_class(columns):
+    columns = tuple(columns)
+
+    if columns not in _row_classes:
+        _row_classes[columns] = type('Row', (Row, ), {
+            '__slots__': (),
+            '_columns': columns,
+            '_index': {column: idx for idx, column in enumerate(columns)},
+        })
+
+    return _row_classes[columns]
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""Offline benchmarks of the flattening of aggregation results
+
+Run all the benchmarks and store their results::
+
+    python -m fiqs.testing.benchmark --output before.json
+
+Then compare another commit against them::
+
+    python -m fiqs.testing.benchmark --output after.json --compare before.json
+
+No Elasticsearch is needed, the results are fabricated.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+
+from fiqs.aggregations import Count, DateHistogram, Sum
+from fiqs.fields import FieldWithChoices, FieldWithRanges
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import START, get_search, to_timestamp
+from fiqs.tree import ResultTree
+
+# The measures we time separately, for each case
+TREE_FLATTEN = 'ResultTree.flatten_result'
+FQUERY_FLATTEN = 'FQuery._flatten_result'
+FQUERY_MISSING_LINES = 'FQuery._add_missing_lines'
+
+
+def _buckets(keys, child, others=False):
+    # Every tenth bucket is missing, for the missing buckets to be filled
+    node = {
+        'buckets': [
+            dict(child(idx), key=key, doc_count=idx % 7 + 1)
+            for idx, key in enumerate(keys)
+            if idx % 10 != 9
+        ],
+    }
+
+    if others:
+        node['doc_count_error_upper_bound'] = 0
+        node['sum_other_doc_count'] = 12
+
+    return node
+
+
+def _metrics(idx):
+    return {'total_sales': {'value': float(idx * 10)}}
+
+
+def histogram_case(nb_buckets):
+    # One bucket per minute, a date histogram never has others
+    end = START + timedelta(minutes=nb_buckets - 1)
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(Sale.timestamp, interval='1m', min=START, max=end),
+    )
+
+    keys = [
+        to_timestamp(START + timedelta(minutes=idx))
+        for idx in range(nb_buckets)
+    ]
+    output = {
+        'aggregations': {
+            'timestamp': _buckets(keys, _metrics),
+        },
+    }
+
+    return fquery, output
+
+
+def terms_case(depth, nb_shops=100, nb_clients=20):
+    # Shop, then payment type, then client
+    levels = [
+        ('shop_id', FieldWithChoices(
+            Sale.shop_id, choices=list(range(nb_shops)))),
+        ('payment_type', Sale.payment_type),
+        ('client_id', FieldWithChoices(
+            Sale.client_id,
+            choices=['client_{}'.format(idx) for idx in range(nb_clients)],
+        )),
+    ][:depth]
+
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(*[field for _, field in levels])
+
+    def node(level):
+        key, field = levels[level]
+        if level == depth - 1:
+            child = _metrics
+        else:
+            def child(idx):
+                return {levels[level + 1][0]: node(level + 1)}
+
+        return _buckets(field.choice_keys(), child, others=True)
+
+    output = {
+        'aggregations': {
+            levels[0][0]: node(0),
+        },
+    }
+
+    return fquery, output
+
+
+def keyed_case(nb_buckets):
+    # One keyed bucket per price band, like a range aggregation
+    ranges = [(idx * 10, (idx + 1) * 10) for idx in range(nb_buckets)]
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithRanges(Sale.price, ranges=ranges),
+    )
+
+    buckets = {}
+    for idx, (start, end) in enumerate(ranges):
+        if idx % 10 == 9:
+            continue
+        bucket = _metrics(idx)
+        bucket.update({'from': start, 'to': end, 'doc_count': idx % 7 + 1})
+        buckets['{} - {}'.format(start, end)] = bucket
+
+    output = {
+        'aggregations': {
+            'price': {'buckets': buckets},
+        },
+    }
+
+    return fquery, output
+
+
+def nested_case(nb_buckets, nb_product_types=5):
+    # Shop, then product type in the nested products
+    product_types = [
+        'product_type_{}'.format(idx) for idx in range(nb_product_types)]
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.product_price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=list(range(nb_buckets))),
+        FieldWithChoices(Sale.product_type, choices=product_types),
+    )
+
+    def products(idx):
+        return {
+            'products': {
+                'doc_count': 12,
+                'product_type': _buckets(product_types, _metrics, others=True),
+            },
+        }
+
+    output = {
+        'aggregations': {
+            'shop_id': _buckets(list(range(nb_buckets)), products, others=True),
+        },
+    }
+
+    return fquery, output
+
+
+# Each case is swept over its parameters, and over the flattening options
+SWEEPS = [
+    ('histogram', histogram_case, {'nb_buckets': [1000, 10000, 100000]}),
+    ('terms', terms_case, {'depth': [1, 2, 3]}),
+    ('keyed', keyed_case, {'nb_buckets': [100, 1000, 10000]}),
+    ('nested', nested_case, {'nb_buckets': [100, 1000, 10000]}),
+]
+
+OPTIONS = {
+    'add_others_line': [False, True],
+    'fill_missing_buckets': [False, True],
+}
+
+
+def _sweep(params):
+    keys = sorted(params.keys())
+    for values in itertools.product(*[params[key] for key in keys]):
+        yield dict(zip(keys, values))
+
+
+def case_id(name, params):
+    return '{}[{}]'.format(name, ','.join(
+        '{}={}'.format(key, params[key]) for key in sorted(params.keys())))
+
+
+def _best_time(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return min(durations)
+
+
+def run_case(builder, params, repeat=3):
+    params = dict(params)
+    add_others_line = params.pop('add_others_line', False)
+    fill_missing_buckets = params.pop('fill_missing_buckets', False)
+
+    fquery, output = builder(**params)
+    kwargs = {
+        'add_others_line': add_others_line,
+        'remove_nested_aggregations': fquery._contains_nested_expressions(),
+    }
+
+    timings = {}
+    timings[TREE_FLATTEN] = _best_time(
+        lambda: ResultTree(output).flatten_result(**kwargs), repeat)
+    timings[FQUERY_FLATTEN] = _best_time(
+        lambda: fquery._flatten_result(output, **kwargs), repeat)
+
+    lines = fquery._flatten_result(output, **kwargs)
+    nb_lines = len(lines)
+    if fill_missing_buckets:
+        # _add_missing_lines extends the lines it is given
+        timings[FQUERY_MISSING_LINES] = _best_time(
+            lambda: fquery._add_missing_lines(list(lines)), repeat)
+        nb_lines = len(fquery._add_missing_lines(list(lines)))
+
+    return {
+        'nb_lines': nb_lines,
+        'timings': timings,
+    }
+
+
+def run_benchmarks(sweeps=None, options=None, repeat=3, name_filter=None,
+                   verbose=False):
+    sweeps = SWEEPS if sweeps is None else sweeps
+    options = OPTIONS if options is None else options
+
+    results = {}
+    for name, builder, params in sweeps:
+        for case_params in _sweep(dict(params, **options)):
+            key = case_id(name, case_params)
+            if name_filter and name_filter not in key:
+                continue
+
+            results[key] = run_case(builder, case_params, repeat=repeat)
+            if verbose:
+                print(key, json.dumps(results[key]['timings'], sort_keys=True))
+
+    return {
+        'python': platform.python_version(),
+        'created_at': datetime.utcnow().isoformat(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare_benchmarks(before, after, threshold=1.2):
+    # Returns the (case, measure, before, after) that got slower
+    regressions = []
+    for key, result in sorted(after['results'].items()):
+        if key not in before['results']:
+            continue
+
+        previous_timings = before['results'][key]['timings']
+        for measure, duration in sorted(result['timings'].items()):
+            previous = previous_timings.get(measure)
+            if previous and duration > threshold * previous:
+                regressions.append((key, measure, previous, duration))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the flattening of aggregation results')
+    parser.add_argument(
+        '--output', help='File in which the results are written, as JSON')
+    parser.add_argument(
+        '--compare', help='Results of a previous run, to compare against')
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help='Slowdown ratio over which a measure is a regression')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--filter', dest='name_filter', help='Only run the matching cases')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        repeat=args.repeat, name_filter=args.name_filter, verbose=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+
+        regressions = compare_benchmarks(
+            before, results, threshold=args.threshold)
+        for key, measure, previous, duration in regressions:
+            print('Regression: {} {} {:.4f}s -> {:.4f}s'.format(
+                key, measure, previous, duration))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
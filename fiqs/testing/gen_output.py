@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""Fabricates Elasticsearch results for a FQuery, without Elasticsearch
+
+    from fiqs.testing.gen_output import gen_output
+
+    output = gen_output(fquery, cardinalities={'shop_id': 1000})
+    lines = fquery._flatten_result(output)
+
+The result has the shape Elasticsearch would give to the query, with
+random doc counts and metrics. It can hold millions of buckets, to test
+the flattening at scale.
+"""
+
+import random
+from datetime import timedelta
+
+from fiqs.aggregations import (
+    DateHistogram,
+    DateRange,
+    Histogram,
+    ReverseNested,
+    get_rounded_date_from_interval,
+    get_timedelta_from_interval,
+    is_interval_standard,
+    is_interval_weekly,
+)
+from fiqs.columns import INTEGER_TYPES
+from fiqs.fields import Field, GroupedField, NestedField
+from fiqs.query import FQuery
+from fiqs.testing.utils import START, to_timestamp
+
+DEFAULT_CARDINALITY = 10
+
+
+def _truncate(keys, cardinality):
+    if cardinality is None:
+        return keys
+    return keys[:cardinality]
+
+
+def _date_histogram_keys(agg, cardinality):
+    interval = agg.params.get('interval', '1d')
+    start = agg.params.get('min')
+    end = agg.params.get('max')
+
+    if is_interval_weekly(interval):
+        delta = timedelta(days=7 * int(interval.rstrip('w') or '1'))
+    elif is_interval_standard(interval):
+        delta = get_timedelta_from_interval(interval)
+    else:
+        # Months and years are approximated
+        delta = timedelta(days=30)
+
+    if start is None or end is None:
+        keys = [
+            START + idx * delta
+            for idx in range(cardinality or DEFAULT_CARDINALITY)
+        ]
+    else:
+        keys = []
+        current = get_rounded_date_from_interval(start, interval)
+        while current <= end:
+            keys.append(current)
+            current += delta
+        keys = _truncate(keys, cardinality)
+
+    return [to_timestamp(key) for key in keys]
+
+
+def _histogram_keys(agg, cardinality):
+    interval = agg.params.get('interval', 1)
+    start = agg.params.get('min')
+    end = agg.params.get('max')
+
+    if start is None or end is None:
+        return [
+            idx * interval
+            for idx in range(cardinality or DEFAULT_CARDINALITY)
+        ]
+
+    # The interval may be a float, each key is computed from the start
+    # so that rounding errors do not add up
+    start = (start // interval) * interval
+    keys = []
+    while start + len(keys) * interval <= end:
+        keys.append(start + len(keys) * interval)
+        if cardinality is not None and len(keys) == cardinality:
+            break
+
+    return keys
+
+
+def _date_range_buckets(agg, cardinality):
+    buckets = []
+    for key, date_range in zip(agg.choice_keys(), agg.params['ranges']):
+        bucket = {'key': key}
+        for bound in ('from', 'to'):
+            if bound in date_range:
+                bucket[bound] = float(to_timestamp(date_range[bound]))
+        buckets.append(bucket)
+
+    return _truncate(buckets, cardinality)
+
+
+def _field_keys(field, cardinality):
+    if field.choices:
+        return _truncate(list(field.choice_keys()), cardinality)
+
+    cardinality = cardinality or DEFAULT_CARDINALITY
+    if field.type in INTEGER_TYPES:
+        return list(range(1, cardinality + 1))
+    if field.type == 'date':
+        return [
+            to_timestamp(START + timedelta(days=idx))
+            for idx in range(cardinality)
+        ]
+
+    return ['{}_{}'.format(field.key, idx) for idx in range(cardinality)]
+
+
+def _level(field_or_exp, cardinality):
+    # Returns the name of the aggregation, its buckets without their
+    # sub aggregations, and whether the buckets are keyed
+    if isinstance(field_or_exp, DateHistogram):
+        keys = _date_histogram_keys(field_or_exp, cardinality)
+        return field_or_exp.field.key, [{'key': key} for key in keys], False
+
+    if isinstance(field_or_exp, Histogram):
+        keys = _histogram_keys(field_or_exp, cardinality)
+        return field_or_exp.field.key, [{'key': key} for key in keys], False
+
+    if isinstance(field_or_exp, DateRange):
+        buckets = _date_range_buckets(field_or_exp, cardinality)
+        return field_or_exp.field.key, buckets, False
+
+    if isinstance(field_or_exp, GroupedField):
+        keys = _truncate(list(field_or_exp.groups.keys()), cardinality)
+        return field_or_exp.key, [{'key': key} for key in keys], True
+
+    if field_or_exp.is_range():
+        buckets = []
+        for field_range in field_or_exp._get_ranges_as_dict():
+            bucket = dict(field_range)
+            for bound in ('from', 'to'):
+                if bucket.get(bound) is not None:
+                    bucket[bound] = float(bucket[bound])
+            buckets.append(bucket)
+        return field_or_exp.key, _truncate(buckets, cardinality), True
+
+    keys = _field_keys(field_or_exp, cardinality)
+    return field_or_exp.key, [{'key': key} for key in keys], False
+
+
+class OutputGenerator(object):
+    def __init__(self, fquery, cardinalities=None, sum_other_doc_count=0,
+                 seed=None):
+        self.fquery = fquery
+        self.cardinalities = cardinalities or {}
+        self.sum_other_doc_count = sum_other_doc_count
+        self.random = random.Random(seed)
+
+        self.levels = []
+        for field_or_exp in fquery._group_by:
+            if isinstance(field_or_exp, NestedField):
+                self.levels.append((field_or_exp.key, None, False))
+            else:
+                name = field_or_exp.key if isinstance(field_or_exp, Field)\
+                    else field_or_exp.field.key
+                self.levels.append(
+                    _level(field_or_exp, self.cardinalities.get(name)))
+
+    def generate(self):
+        aggregations = {}
+        doc_count = self._fill(aggregations, 0)
+
+        return {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {
+                'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': doc_count, 'max_score': 0.0, 'hits': []},
+            'aggregations': aggregations,
+        }
+
+    def _fill(self, node, level_idx):
+        # Fills the node with the aggregations from the given level,
+        # and returns its doc count
+        if level_idx == len(self.levels):
+            doc_count = self.random.randint(1, 100)
+            self._add_metrics(node, doc_count)
+            return doc_count
+
+        name, buckets, keyed = self.levels[level_idx]
+        if buckets is None:
+            # Nested aggregation, it has no buckets
+            nested_node = {}
+            nested_node['doc_count'] = self._fill(nested_node, level_idx + 1)
+            node[name] = nested_node
+            return nested_node['doc_count']
+
+        doc_count = 0
+        filled_buckets = []
+        for bucket in buckets:
+            bucket = dict(bucket)
+            bucket['doc_count'] = self._fill(bucket, level_idx + 1)
+            doc_count += bucket['doc_count']
+            filled_buckets.append(bucket)
+
+        # Elasticsearch sorts terms buckets by doc count
+        if self._is_terms_level(level_idx):
+            filled_buckets.sort(
+                key=lambda bucket: bucket['doc_count'], reverse=True)
+
+        if keyed:
+            agg_node = {
+                'buckets': {
+                    bucket.pop('key'): bucket for bucket in filled_buckets
+                },
+            }
+        else:
+            agg_node = {'buckets': filled_buckets}
+
+        if self._is_terms_level(level_idx):
+            agg_node['doc_count_error_upper_bound'] = 0
+            agg_node['sum_other_doc_count'] = self.sum_other_doc_count
+            doc_count += self.sum_other_doc_count
+
+        node[name] = agg_node
+        return doc_count
+
+    def _is_terms_level(self, level_idx):
+        field_or_exp = self.fquery._group_by[level_idx]
+        return isinstance(field_or_exp, Field)\
+            and not isinstance(field_or_exp, (GroupedField, NestedField))\
+            and not field_or_exp.is_range()
+
+    def _metric(self):
+        return {'value': round(self.random.uniform(0, 1000), 2)}
+
+    def _add_metrics(self, node, doc_count):
+        for key, expression in self.fquery._expressions.items():
+            if isinstance(expression, ReverseNested):
+                reverse_node = {
+                    'doc_count': self.random.randint(1, doc_count)}
+                for nested_key, nested_expression\
+                        in expression._expressions.items():
+                    if nested_expression.is_field_agg():
+                        reverse_node[nested_key] = self._metric()
+                node[expression.reverse_agg_params()['name']] = reverse_node
+
+            elif expression.is_field_agg():
+                node[key] = self._metric()
+
+
+def gen_output(fquery_or_group_by, cardinalities=None, sum_other_doc_count=0,
+               seed=None):
+    """Returns a fake Elasticsearch result for the query
+
+    `fquery_or_group_by` is a FQuery, or a list of fields and aggregates
+    to group by. `cardinalities` gives the number of buckets of each
+    aggregation, by name, and defaults to the choices of the field.
+    `sum_other_doc_count` is added to each terms aggregation.
+    """
+    fquery = fquery_or_group_by
+    if not isinstance(fquery, FQuery):
+        fquery = FQuery(None).group_by(*fquery_or_group_by)
+
+    generator = OutputGenerator(
+        fquery,
+        cardinalities=cardinalities,
+        sum_other_doc_count=sum_other_doc_count,
+        seed=seed,
+    )
+    return generator.generate()
@@ -1,14 +1,73 @@
 # -*- coding: utf-8 -*-
 
+import copy
+from datetime import datetime
+
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 
+# First day of the fake results
+START = datetime(2016, 1, 1)
+EPOCH = datetime(1970, 1, 1)
+
 
 def get_client():
     return Elasticsearch(['http://localhost:8200'], timeout=60)
 
 
+def to_timestamp(dt):
+    # Dates are given as milliseconds by Elasticsearch
+    return int((dt - EPOCH).total_seconds() * 1000)
+
+
 def get_search(client=None, indices=None):
     indices = indices or '*'
     client = client or get_client()
     return Search(using=client, index=indices)
+
+
+class StubClient(object):
+    """Answers searches with the given function instead of Elasticsearch
+
+    The function gets the body of the search and returns the result.
+    """
+
+    def __init__(self, search_func):
+        self.search_func = search_func
+        self.bodies = []
+        self.nb_msearch = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.bodies.append(body)
+        return self.search_func(body)
+
+    def msearch(self, body=None, index=None, **kwargs):
+        # Searches failing are reported like Elasticsearch does,
+        # in place of their response
+        self.nb_msearch += 1
+
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(
+                    index=header.get('index', index), body=search_body))
+            except Exception as e:
+                responses.append({
+                    'error': {'type': type(e).__name__, 'reason': str(e)},
+                    'status': 500,
+                })
+
+        return {'responses': responses}
+
+
+class AsyncStubClient(StubClient):
+    """Asynchronous version of StubClient, for FQuery.eval_async"""
+
+    async def search(self, index=None, body=None, **kwargs):
+        self.bodies.append(body)
+        return self.search_func(body)
+
+
+def output_client(output, client_class=StubClient):
+    """Stub client answering all the searches with a copy of output"""
+    return client_class(lambda body: copy.deepcopy(output))
@@ -8,7 +8,11 @@ import pytest
 from elasticsearch.helpers import bulk
 from elasticsearch_dsl import Mapping, Nested
 
-from fiqs.testing.utils import get_client
+from fiqs.aggregations import Sum
+from fiqs.fields import FieldWithChoices
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_client, get_search
 
 SALE_INDEX_NAME = 'test_sale'
 TRAFFIC_INDEX_NAME = 'test_traffic'
@@ -184,3 +188,12 @@ def load_output(name):
         output = json.load(f)
 
     return output
+
+
+def total_sales_by_shop_fquery(client, **kwargs):
+    # The query of the 'total_sales_by_shop' output, kwargs are given to FQuery
+    return FQuery(get_search(client=client), **kwargs).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(1, 13)),
+    )
@@ -2,7 +2,7 @@
 
 from datetime import datetime, timedelta
 
-from fiqs.aggregations import DateHistogram
+from fiqs.aggregations import Avg, Count, DateHistogram, ReverseNested, Sum
 from fiqs.testing.models import Sale
 
 
@@ -118,3 +118,49 @@ def test_date_histogram_choice_keys_month_intervals_offset():
     ]
     keys = date_histogram.choice_keys()
     assert expected_keys == keys
+
+
+def test_reverse_nested_expressions():
+    reverse_nested = ReverseNested(
+        Sale,
+        Count(Sale),
+        avg_sales=Avg(Sale.price),
+    )
+
+    expressions = reverse_nested.expressions
+    assert sorted(expressions.keys()) == [
+        'reverse_nested_root__avg_sales',
+        'reverse_nested_root__doc_count',
+    ]
+    # The keys are only built once
+    assert reverse_nested.expressions is expressions
+
+
+def test_reverse_nested_create_empty_line():
+    reverse_nested = ReverseNested(Sale, total_sales=Sum(Sale.price))
+
+    line = reverse_nested.create_empty_line()
+    assert line == {
+        'reverse_nested_root__total_sales': None,
+        'reverse_nested_root__doc_count': 0,
+    }
+
+    # Each line can be updated on its own
+    line['reverse_nested_root__total_sales'] = 12
+    assert reverse_nested.create_empty_line() == {
+        'reverse_nested_root__total_sales': None,
+        'reverse_nested_root__doc_count': 0,
+    }
+
+
+def test_date_histogram_agg_params_twice():
+    start = datetime(2016, 1, 1)
+    end = datetime(2016, 1, 31)
+    date_histogram = DateHistogram(
+        Sale.timestamp, interval='1d', min=start, max=end)
+
+    params = date_histogram.agg_params()
+    assert params['extended_bounds'] == {'min': start, 'max': end}
+    assert date_histogram.agg_params() == params
+    assert date_histogram.min == start
+    assert date_histogram.max == end
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fiqs import query
+from fiqs.cache import ResultCache
+from fiqs.testing.utils import AsyncStubClient, output_client
+from fiqs.tests.conftest import load_output, total_sales_by_shop_fquery
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super(RecordingExecutor, self).__init__(max_workers=1)
+        self.nb_calls = 0
+
+    def submit(self, *args, **kwargs):
+        self.nb_calls += 1
+        return super(RecordingExecutor, self).submit(*args, **kwargs)
+
+
+def test_eval_async():
+    output = load_output('total_sales_by_shop')
+    expected = total_sales_by_shop_fquery(output_client(output)).eval()
+
+    client = output_client(output, AsyncStubClient)
+    lines = _run(total_sales_by_shop_fquery(client).eval_async())
+
+    assert lines == expected
+    assert len(client.bodies) == 1
+
+    fquery = total_sales_by_shop_fquery(client)
+    lines = _run(fquery.eval_async(limit=3, offset=2))
+    assert lines == expected[2:5]
+
+
+def test_eval_async_not_flat():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output, AsyncStubClient)
+
+    result = _run(total_sales_by_shop_fquery(client).eval_async(flat=False))
+
+    assert result.aggregations.shop_id.buckets[0].key ==\
+        output['aggregations']['shop_id']['buckets'][0]['key']
+
+
+def test_eval_async_concurrent():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output, AsyncStubClient)
+
+    async def eval_all():
+        return await asyncio.gather(*[
+            total_sales_by_shop_fquery(client).eval_async() for _ in range(5)
+        ])
+
+    results = _run(eval_all())
+
+    assert len(client.bodies) == 5
+    assert all(lines == results[0] for lines in results)
+
+
+def test_eval_async_executor(monkeypatch):
+    output = load_output('total_sales_by_shop')
+    client = output_client(output, AsyncStubClient)
+    executor = RecordingExecutor()
+
+    fquery = total_sales_by_shop_fquery(client)
+
+    # Small results are flattened in the loop
+    lines = _run(fquery.eval_async(executor=executor))
+    assert executor.nb_calls == 0
+
+    monkeypatch.setattr(query, 'ASYNC_EXECUTOR_MIN_BUCKETS', 5)
+    assert _run(fquery.eval_async(executor=executor)) == lines
+    assert executor.nb_calls == 1
+
+    executor.shutdown()
+
+
+def test_eval_async_cache():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output, AsyncStubClient)
+    cache = ResultCache()
+
+    fquery = total_sales_by_shop_fquery(client, cache=cache)
+
+    lines = _run(fquery.eval_async())
+    assert _run(fquery.eval_async()) == lines
+    assert len(client.bodies) == 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+from elasticsearch.exceptions import TransportError
+
+from fiqs.aggregations import Count, Ratio, Sum
+from fiqs.batch import FQueryBatch, eval_many
+from fiqs.cache import ResultCache
+from fiqs.exceptions import ConfigurationError
+from fiqs.fields import FieldWithChoices
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import StubClient, get_search
+from fiqs.tests.conftest import load_output, total_sales_by_shop_fquery
+
+
+def _search_func(fail_payment_type=False):
+    by_shop = load_output('total_sales_by_shop')
+    by_payment_type = load_output('total_sales_by_payment_type_by_shop')
+
+    def search_func(body):
+        if 'payment_type' not in body['aggs']:
+            return copy.deepcopy(by_shop)
+        if fail_payment_type:
+            raise ValueError('search_phase_execution_exception')
+        return copy.deepcopy(by_payment_type)
+
+    return search_func
+
+
+def _by_payment_type(client):
+    return FQuery(get_search(client=client)).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        FieldWithChoices(Sale.shop_id, choices=range(1, 13)),
+    )
+
+
+def test_batch_eval():
+    client = StubClient(_search_func())
+    expected = [
+        total_sales_by_shop_fquery(client).eval(),
+        _by_payment_type(client).eval(limit=5),
+        _by_payment_type(client).eval(format='rows'),
+    ]
+
+    client = StubClient(_search_func())
+    batch = FQueryBatch().add(
+        total_sales_by_shop_fquery(client),
+    ).add(
+        _by_payment_type(client), limit=5,
+    ).add(
+        _by_payment_type(client), format='rows',
+    )
+
+    assert len(batch) == 3
+    assert batch.eval() == expected
+
+    # A single request for all the queries
+    assert client.nb_msearch == 1
+    assert len(client.bodies) == 3
+
+
+def test_batch_eval_errors():
+    client = StubClient(_search_func(fail_payment_type=True))
+    computed = FQuery(get_search(client=client)).values(
+        ratio=Ratio(Count(Sale), Count(Sale)),
+    ).group_by(Sale.shop_id)
+
+    by_shop, by_payment_type, not_flat = FQueryBatch().add(
+        total_sales_by_shop_fquery(client),
+    ).add(
+        _by_payment_type(client),
+    ).add(
+        computed, flat=False,
+    ).eval()
+
+    assert len(by_shop) == 12
+    assert isinstance(by_payment_type, TransportError)
+    assert by_payment_type.error == 'ValueError'
+    assert isinstance(not_flat, ConfigurationError)
+
+    # The query failing to be configured was not sent
+    assert len(client.bodies) == 2
+
+
+def test_batch_eval_cache():
+    client = StubClient(_search_func())
+    cache = ResultCache()
+    lines = total_sales_by_shop_fquery(client, cache=cache).eval()
+
+    results = eval_many([
+        total_sales_by_shop_fquery(client, cache=cache),
+        _by_payment_type(client),
+    ])
+
+    assert results[0] == lines
+    assert len(results[1]) == 3 * 12
+
+    # The cached query was not sent again
+    assert len(client.bodies) == 2
+    assert 'payment_type' in client.bodies[1]['aggs']
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from fiqs import cache as cache_module
+from fiqs.aggregations import Addition, Count, Ratio, Sum
+from fiqs.cache import DiskBackend, LRUCache, ResultCache
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search, output_client
+from fiqs.tests.conftest import load_output, total_sales_by_shop_fquery
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.get('a') == 1
+    assert cache.get('c') is None
+    assert cache.get('c', 3) == 3
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(max_entries=None, max_bytes=10)
+    cache.set('a', b'12345')
+    cache.set('b', b'1234')
+    assert cache.nb_bytes == 9
+
+    cache.set('c', b'12')
+    assert cache.get('a') is None
+    assert cache.nb_bytes == 6
+
+    # Too large to be cached
+    cache.set('b', b'12345678901')
+    assert cache.get('b') is None
+    assert cache.nb_bytes == 2
+
+
+def test_disk_backend(tmp_path):
+    backend = DiskBackend(str(tmp_path / 'cache'), max_bytes=10)
+    backend.set('a', b'12345')
+    backend.set('b', b'1234')
+    assert backend.get('a') == b'12345'
+    assert backend.get('c') is None
+
+    # 'b' is the least recently used entry
+    path = backend._path('b')
+    os.utime(path, (0, 0))
+    backend.set('c', b'12')
+    assert backend.get('b') is None
+    assert backend.get('a') == b'12345'
+
+    # Another backend on the same directory sees the entries
+    assert DiskBackend(str(tmp_path / 'cache')).get('c') == b'12'
+
+    backend.clear()
+    assert backend.get('a') is None
+
+
+def test_result_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now[0])
+
+    cache = ResultCache(ttl=60)
+    cache.set('key', [{'shop_id': 1}])
+    assert cache.get('key') == [{'shop_id': 1}]
+
+    now[0] += 61
+    assert cache.get('key') is None
+    assert len(cache.backend) == 0
+
+
+def test_fquery_cache_lines():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output)
+    fquery = total_sales_by_shop_fquery(client, cache=ResultCache())
+
+    lines = fquery.eval()
+    assert len(lines) == 12
+
+    # Elasticsearch is not called again
+    cached_lines = fquery.eval()
+    assert len(client.bodies) == 1
+    assert cached_lines == lines
+
+    # Each hit gets its own lines
+    cached_lines[0]['total_sales'] = None
+    assert fquery.eval() == lines
+
+    # Other options, or another body, are other entries
+    assert len(fquery.eval(fill_missing_buckets=False)) == 10
+    fquery.search = fquery.search.filter('terms', shop_id=[1, 2])
+    fquery.eval()
+    assert len(client.bodies) == 3
+
+
+def test_fquery_cache_lines_query_definition():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output)
+    cache = ResultCache()
+
+    def fquery(**expressions):
+        return FQuery(get_search(client=client), cache=cache).values(
+            total_sales=Sum(Sale.price), **expressions
+        ).group_by(Sale.shop_id)
+
+    # Computed fields are not part of the body
+    added = fquery(add=Addition(Count(Sale), Count(Sale))).eval()
+    ratios = fquery(ratio=Ratio(Count(Sale), Count(Sale))).eval()
+    assert len(client.bodies) == 2
+    assert 'add' in added[0] and 'ratio' not in added[0]
+    assert 'ratio' in ratios[0] and 'add' not in ratios[0]
+
+    # Nor are the choices of the fields
+    lines = total_sales_by_shop_fquery(client, cache=cache).eval()
+    assert len(client.bodies) == 3
+    assert len(lines) == 12
+
+
+def test_fquery_cache_response(tmp_path):
+    output = load_output('total_sales_by_shop')
+    client = output_client(output)
+    cache = ResultCache(
+        backend=DiskBackend(str(tmp_path)), cache_response=True)
+    fquery = total_sales_by_shop_fquery(client, cache=cache)
+
+    lines = fquery.eval()
+
+    # The response is flattened again, with the new options
+    assert fquery.eval() == lines
+    assert len(fquery.eval(fill_missing_buckets=False)) == 10
+    result = fquery.eval(flat=False)
+    assert len(client.bodies) == 1
+
+    assert result.aggregations.shop_id.buckets[0].key ==\
+        output['aggregations']['shop_id']['buckets'][0]['key']
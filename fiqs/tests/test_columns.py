@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import pytest
+
+from fiqs import flatten_result
+from fiqs.aggregations import Count, DateHistogram, Sum
+from fiqs.columns import lines_to_columns
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import load_output
+
+np = pytest.importorskip('numpy')
+
+
+def test_lines_to_columns():
+    columns = lines_to_columns([
+        {'shop_id': 1, 'doc_count': 10, 'total_sales': 12.5},
+        {'shop_id': 2, 'doc_count': 0, 'total_sales': None},
+        {'shop_id': u'others', 'doc_count': 5},
+    ])
+
+    assert list(columns.keys()) == ['shop_id', 'doc_count', 'total_sales']
+
+    assert columns['doc_count'].dtype == np.int64
+    assert columns['doc_count'].tolist() == [10, 0, 5]
+
+    assert columns['total_sales'].dtype == np.float64
+    assert columns['total_sales'].tolist() == [12.5, None, None]
+    assert columns['total_sales'].mask.tolist() == [False, True, True]
+
+    # Mixed types are kept as python objects
+    assert columns['shop_id'].dtype == object
+    assert columns['shop_id'].tolist() == [1, 2, u'others']
+
+
+def test_lines_to_columns_dates():
+    columns = lines_to_columns([
+        {'timestamp': datetime(2016, 1, 1)},
+        {'timestamp': None},
+    ])
+
+    assert columns['timestamp'].dtype == np.dtype('datetime64[ms]')
+    assert columns['timestamp'][0] == np.datetime64('2016-01-01T00:00:00')
+    assert columns['timestamp'].mask.tolist() == [False, True]
+
+
+def test_lines_to_columns_no_lines():
+    assert lines_to_columns([]) == {}
+
+
+def test_flatten_result_columns():
+    result = load_output('total_sales_by_payment_type_by_shop')
+    lines = flatten_result(result)
+    columns = flatten_result(result, output='columns')
+
+    assert set(columns.keys()) == set(lines[0].keys())
+    for key, values in columns.items():
+        assert len(values) == len(lines)
+        assert values.tolist() == [line[key] for line in lines]
+
+    assert columns['shop_id'].dtype == np.int64
+    assert columns['doc_count'].dtype == np.int64
+    assert columns['total_sales'].dtype == np.float64
+
+
+def test_fquery_columns():
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 31),
+        ),
+    )
+    fquery._configure_search()
+
+    result = load_output('total_sales_day_by_day')
+    result['aggregations']['timestamp']['buckets'].pop(0)
+
+    columns = lines_to_columns(fquery._iter_with_missing_lines(
+        fquery._iter_flatten_result(result)))
+
+    assert len(columns['timestamp']) == 31
+    assert columns['timestamp'].dtype == np.dtype('datetime64[ms]')
+    assert not columns['timestamp'].mask.any()
+
+    # The missing bucket comes last, with no metric
+    assert columns['doc_count'][-1] == 0
+    assert columns['total_sales'].mask.tolist() == [False] * 30 + [True]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import copy
+from datetime import datetime
+
+import pytest
+
+from fiqs.aggregations import Avg, Count, DateHistogram, Ratio, Sum
+from fiqs.dataframes import columns_to_dataframe
+from fiqs.fields import FieldWithChoices
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search, output_client
+from fiqs.tests.conftest import load_output
+
+pd = pytest.importorskip('pandas')
+
+
+def _fquery(output):
+    client = output_client(output)
+    return FQuery(get_search(client=client))
+
+
+def test_columns_to_dataframe():
+    df = columns_to_dataframe({
+        'shop_id': [1, 2, u'others'],
+        'doc_count': [10, 0, 5],
+        'total_sales': [12, None, None],
+        'avg_sales': [12.5, None, 3.0],
+    }, fields={
+        'total_sales': Sum(Sale.price),
+    }, choices={
+        'shop_id': [1, 2, 3],
+    })
+
+    assert list(df.columns) == [
+        'shop_id', 'doc_count', 'total_sales', 'avg_sales']
+
+    # The others key is kept as a category
+    assert df['shop_id'].dtype == 'category'
+    assert list(df['shop_id'].cat.categories) == [1, 2, 3, u'others']
+    assert df['shop_id'].tolist() == [1, 2, u'others']
+
+    assert df['doc_count'].dtype == 'int64'
+    assert df['total_sales'].dtype == 'Int64'
+    assert df['total_sales'].isna().tolist() == [False, True, True]
+    assert df['avg_sales'].dtype == 'float64'
+
+
+def test_columns_to_dataframe_no_values():
+    df = columns_to_dataframe({
+        'timestamp': [None, None],
+        'total_sales': [None, None],
+        'client_id': [None, None],
+    }, fields={
+        'timestamp': Sale.timestamp,
+        'total_sales': Sum(Sale.price),
+    })
+
+    # The type comes from the fields
+    assert df['timestamp'].dtype == 'datetime64[ms]'
+    assert df['total_sales'].dtype == 'Int64'
+    assert df['client_id'].dtype == object
+
+
+def test_fquery_to_dataframe_single_level():
+    output = load_output('total_sales_day_by_day')
+    output['aggregations']['timestamp']['buckets'].pop(1)
+
+    fquery = _fquery(output).values(
+        Count(Sale),
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 31),
+        ),
+    )
+
+    lines = copy.deepcopy(fquery).eval()
+    df = fquery.to_dataframe()
+
+    assert len(df) == len(lines)
+    assert df['timestamp'].dtype == 'datetime64[ms]'
+    assert df['timestamp'].tolist() == [line['timestamp'] for line in lines]
+    assert df['doc_count'].tolist() == [line['doc_count'] for line in lines]
+
+    # The missing days have no sales
+    assert df['total_sales'].dtype == 'Int64'
+    assert df['total_sales'].isna().tolist() ==\
+        [line['total_sales'] is None for line in lines]
+    assert df['total_sales'].isna().any()
+
+
+def test_fquery_to_dataframe_choices():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    fquery = _fquery(output).values(
+        total_sales=Sum(Sale.price),
+        avg_sales=Avg(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        FieldWithChoices(Sale.shop_id, choices=range(1, 13)),
+    )
+
+    df = fquery.to_dataframe()
+
+    # 12 shops by payment type, 2 of them are missing
+    assert len(df) == 3 * 12
+    assert df['payment_type'].dtype == 'category'
+    assert list(df['payment_type'].cat.categories) ==\
+        ['wire_transfer', 'cash', 'store_credit']
+    assert df['shop_id'].dtype == 'category'
+    assert list(df['shop_id'].cat.categories) == list(range(1, 13))
+
+    assert df['doc_count'].dtype == 'int64'
+    assert df['total_sales'].dtype == 'Int64'
+    assert df['avg_sales'].dtype == 'float64'
+
+
+def test_fquery_to_dataframe_computed_fields():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    fquery = _fquery(output).values(
+        total_sales=Sum(Sale.price),
+        ratio=Ratio(Count(Sale), Count(Sale)),
+    ).group_by(
+        Sale.payment_type,
+        Sale.shop_id,
+    )
+
+    df = fquery.to_dataframe(fill_missing_buckets=False)
+
+    assert len(df) == 3 * 10
+    assert df['ratio'].tolist() == [100.0] * 3 * 10
+    assert df['shop_id'].dtype == 'int64'
@@ -94,3 +94,11 @@ def test_field_model_access_child():
     assert SaleWithoutProducts.price.model == SaleWithoutProducts
     assert SaleWithProducts.price.model == SaleWithProducts
     assert SaleWithParts.price.model == SaleWithParts
+
+
+def test_date_field_casted_values():
+    timestamps = [1451606400000, 1451606400123, 1451692800000]
+    field = fields.DateField()
+
+    assert field.get_casted_values(timestamps) == [
+        field.get_casted_value(timestamp) for timestamp in timestamps]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from fiqs.aggregations import (
+    Avg,
+    Count,
+    DateHistogram,
+    Histogram,
+    ReverseNested,
+    Sum,
+)
+from fiqs.fields import FieldWithChoices, FieldWithRanges, GroupedField
+from fiqs.query import FQuery
+from fiqs.testing.gen_output import gen_output
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+
+
+def test_gen_output_date_histogram_by_payment_type():
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 31),
+        ),
+        Sale.payment_type,
+    )
+
+    output = gen_output(fquery, seed=42)
+    lines = fquery._flatten_result(output)
+
+    # 31 days, 3 payment types
+    assert len(lines) == 31 * 3
+    assert fquery._get_missing_lines(lines) == []
+    assert lines[0]['timestamp'] == datetime(2016, 1, 1)
+    assert sum(line['doc_count'] for line in lines) ==\
+        output['hits']['total']
+
+    for line in lines:
+        assert type(line['total_sales']) == int
+
+    # The query can still be configured after the generation
+    assert fquery._configure_search().to_dict()['aggs']['timestamp'][
+        'date_histogram']['extended_bounds'] == {
+            'min': datetime(2016, 1, 1),
+            'max': datetime(2016, 1, 31),
+        }
+
+
+def test_gen_output_float_histogram():
+    output = gen_output([
+        Histogram(Sale.price, interval=0.5, min=1, max=3),
+    ])
+
+    keys = [
+        bucket['key']
+        for bucket in output['aggregations']['price']['buckets']
+    ]
+    assert keys == [1.0, 1.5, 2.0, 2.5, 3.0]
+
+
+def test_gen_output_seed():
+    group_by = [Sale.shop_id, Sale.client_id]
+
+    assert gen_output(group_by, seed=1) == gen_output(group_by, seed=1)
+    assert gen_output(group_by, seed=1) != gen_output(group_by, seed=2)
+
+
+def test_gen_output_cardinalities():
+    output = gen_output(
+        [Sale.shop_id, Sale.client_id],
+        cardinalities={'shop_id': 1000, 'client_id': 50},
+    )
+
+    shop_buckets = output['aggregations']['shop_id']['buckets']
+    assert len(shop_buckets) == 1000
+    assert sorted(bucket['key'] for bucket in shop_buckets) ==\
+        list(range(1, 1001))
+    assert len(shop_buckets[0]['client_id']['buckets']) == 50
+
+    # Terms buckets are sorted by doc count, like Elasticsearch does
+    doc_counts = [bucket['doc_count'] for bucket in shop_buckets]
+    assert doc_counts == sorted(doc_counts, reverse=True)
+
+
+def test_gen_output_sum_other_doc_count():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(1, 6)),
+        Sale.payment_type,
+    )
+
+    output = gen_output(fquery, sum_other_doc_count=7)
+    lines = fquery._flatten_result(output, add_others_line=True)
+
+    # One others line by shop, and one for the shops
+    others_lines = [
+        line for line in lines if u'others' in line.values()]
+    assert len(others_lines) == 5 + 1
+    assert all(line['doc_count'] == 7 for line in others_lines)
+
+
+def test_gen_output_nested_and_reverse_nested():
+    fquery = FQuery(get_search()).values(
+        ReverseNested(
+            Sale,
+            avg_sales=Avg(Sale.price),
+        ),
+        avg_product_price=Avg(Sale.product_price),
+    ).group_by(
+        Sale.shop_id,
+        Sale.product_type,
+    )
+
+    output = gen_output(fquery, cardinalities={'product_type': 4})
+    products = output['aggregations']['shop_id']['buckets'][0]['products']
+    assert products['doc_count'] == sum(
+        bucket['doc_count'] for bucket in products['product_type']['buckets'])
+
+    lines = fquery._flatten_result(
+        output,
+        remove_nested_aggregations=fquery._contains_nested_expressions(),
+    )
+    assert len(lines) == 10 * 4
+
+    for line in lines:
+        assert line['avg_product_price'] is not None
+        assert line['reverse_nested_root__avg_sales'] is not None
+        assert line['reverse_nested_root__doc_count'] <= line['doc_count']
+
+
+def test_gen_output_keyed_buckets():
+    ranges = [{
+        'from': 1,
+        'to': 5,
+        'key': '1 - 5',
+    }, {
+        'from': 5,
+        'key': '5+',
+    }]
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+    ).group_by(
+        FieldWithRanges(Sale.shop_id, ranges=ranges),
+        GroupedField(Sale.payment_type, groups={
+            'cash': ['cash'],
+            'other': ['wire_transfer', 'store_credit'],
+        }),
+    )
+
+    output = gen_output(fquery)
+    buckets = output['aggregations']['shop_id']['buckets']
+    assert sorted(buckets.keys()) == ['1 - 5', '5+']
+    assert buckets['5+']['from'] == 5.0
+    assert 'to' not in buckets['5+']
+    assert sorted(buckets['5+']['payment_type']['buckets'].keys()) ==\
+        ['cash', 'other']
+
+    lines = fquery._flatten_result(output)
+    assert len(lines) == 2 * 2
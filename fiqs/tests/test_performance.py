@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import time
 from datetime import datetime
 
 import pytest
 
-from fiqs.aggregations import Count, DateHistogram
+from fiqs import flatten_result
+from fiqs.aggregations import Count, DateHistogram, Sum
 from fiqs.query import FQuery
+from fiqs.testing import benchmark
+from fiqs.testing.gen_output import gen_output
 from fiqs.testing.models import Sale
 from fiqs.testing.utils import get_search
 from fiqs.tests.conftest import load_output, write_fquery_output
@@ -50,3 +55,214 @@ def test_flatten_performance():
         result,
         remove_nested_aggregations=fquery._contains_nested_expressions(),
     )
+
+
+def _histogram_output(nb_buckets):
+    # One bucket per minute, like a date histogram
+    return {
+        'aggregations': {
+            'timestamp': {
+                'buckets': [
+                    {
+                        'key': 1451606400000 + idx * 60000,
+                        'doc_count': idx % 7,
+                    }
+                    for idx in range(nb_buckets)
+                ],
+            },
+        },
+    }
+
+
+def _time_flatten(nb_buckets, **kwargs):
+    output = _histogram_output(nb_buckets)
+
+    start = time.time()
+    lines = flatten_result(output, **kwargs)
+    duration = time.time() - start
+
+    assert len(lines) == nb_buckets
+    return duration
+
+
+@pytest.mark.performance
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_flatten_performance_linear_scaling(single_pass):
+    base_size = 200
+    durations = {
+        factor: _time_flatten(base_size * factor, single_pass=single_pass)
+        for factor in [10, 100, 1000]
+    }
+
+    # Time spent per bucket should not grow with the number of buckets
+    per_bucket_10 = durations[10] / (base_size * 10)
+    per_bucket_1000 = durations[1000] / (base_size * 1000)
+    assert per_bucket_1000 < 3 * per_bucket_10
+
+
+def _keyed_ranges_output(nb_buckets):
+    # One keyed bucket per price band, like a range aggregation
+    return {
+        'aggregations': {
+            'price': {
+                'buckets': {
+                    '{} - {}'.format(idx * 10, (idx + 1) * 10): {
+                        'from': idx * 10,
+                        'to': (idx + 1) * 10,
+                        'doc_count': idx % 7,
+                    }
+                    for idx in range(nb_buckets)
+                },
+            },
+        },
+    }
+
+
+def _time_flatten_keyed(nb_buckets, **kwargs):
+    output = _keyed_ranges_output(nb_buckets)
+
+    start = time.time()
+    lines = flatten_result(output, **kwargs)
+    duration = time.time() - start
+
+    assert len(lines) == nb_buckets
+    return duration
+
+
+@pytest.mark.performance
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_flatten_keyed_performance_linear_scaling(single_pass):
+    durations = {
+        nb_buckets: _time_flatten_keyed(nb_buckets, single_pass=single_pass)
+        for nb_buckets in [500, 5000]
+    }
+
+    # Time spent per bucket should not grow with the number of buckets
+    per_bucket_500 = durations[500] / 500
+    per_bucket_5000 = durations[5000] / 5000
+    assert per_bucket_5000 < 3 * per_bucket_500
+
+
+def _deeply_nested_output(nb_buckets, depth):
+    # Each shop bucket holds `depth` nested aggregations, one in another
+    def nested_node(level):
+        if level == depth:
+            return {
+                'buckets': [{'key': 'product_type_1', 'doc_count': 2}],
+            }
+
+        return {
+            'doc_count': 2,
+            'nested_{}'.format(level): nested_node(level + 1),
+        }
+
+    return {
+        'aggregations': {
+            'shop_id': {
+                'buckets': [
+                    dict(nested_node(0), key=idx)
+                    for idx in range(nb_buckets)
+                ],
+            },
+        },
+    }
+
+
+def _time_flatten_nested(depth):
+    output = _deeply_nested_output(100, depth)
+
+    start = time.time()
+    lines = flatten_result(output)
+    duration = time.time() - start
+
+    assert len(lines) == 100
+    return duration
+
+
+@pytest.mark.performance
+def test_remove_nested_aggregations_performance():
+    durations = {
+        depth: _time_flatten_nested(depth)
+        for depth in [20, 200]
+    }
+
+    # Time spent per nested node should not grow with the depth
+    per_node_20 = durations[20] / 20
+    per_node_200 = durations[200] / 200
+    assert per_node_200 < 3 * per_node_20
+
+
+@pytest.mark.performance
+def test_flatten_single_level_performance():
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1m',
+        ),
+    )
+    output = _histogram_output(100000)
+
+    start = time.time()
+    lines = fquery._flatten_single_level(output)
+    fast_duration = time.time() - start
+
+    start = time.time()
+    generic_lines = list(fquery._iter_flatten_result(output))
+    generic_duration = time.time() - start
+
+    assert lines == generic_lines
+    assert fast_duration < generic_duration
+
+
+@pytest.mark.performance
+def test_benchmarks(tmpdir):
+    sweeps = [
+        ('histogram', benchmark.histogram_case, {'nb_buckets': [100]}),
+        ('terms', benchmark.terms_case, {'depth': [2]}),
+        ('keyed', benchmark.keyed_case, {'nb_buckets': [100]}),
+        ('nested', benchmark.nested_case, {'nb_buckets': [10]}),
+    ]
+    results = benchmark.run_benchmarks(sweeps=sweeps, repeat=1)
+
+    assert len(results['results']) == 16
+    result = results['results'][
+        'terms[add_others_line=True,depth=2,fill_missing_buckets=True]']
+    # 100 shops, 3 payment types, with the others lines
+    assert result['nb_lines'] == 100 * 3 + 90 + 1
+    assert set(result['timings'].keys()) == {
+        benchmark.TREE_FLATTEN,
+        benchmark.FQUERY_FLATTEN,
+        benchmark.FQUERY_MISSING_LINES,
+    }
+
+    # Results are stored as JSON, to be compared between commits
+    output = str(tmpdir.join('before.json'))
+    assert benchmark.main(['--repeat', '1', '--filter', 'keyed[', '--output',
+                           output]) == 0
+    assert benchmark.main(['--repeat', '1', '--filter', 'keyed[', '--compare',
+                           output, '--threshold', '1000']) == 0
+
+    slower = copy.deepcopy(results)
+    for result in slower['results'].values():
+        result['timings'][benchmark.FQUERY_FLATTEN] *= 2
+    regressions = benchmark.compare_benchmarks(results, slower)
+    assert len(regressions) == 16
+    assert all(
+        measure == benchmark.FQUERY_FLATTEN for _, measure, _, _ in regressions)
+
+
+@pytest.mark.performance
+def test_flatten_million_buckets():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+        Sale.client_id,
+    )
+    output = gen_output(
+        fquery, cardinalities={'shop_id': 1000, 'client_id': 1000})
+
+    lines = fquery._flatten_result(output)
+    assert len(lines) == 1000 * 1000
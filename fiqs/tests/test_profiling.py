@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from fiqs import profiling
+from fiqs.aggregations import Ratio, Sum
+from fiqs.fields import FieldWithChoices
+from fiqs.profiling import (
+    CASTING,
+    COMPUTED_FIELDS,
+    CONFIGURE_SEARCH,
+    EXECUTE,
+    FLATTEN,
+    MISSING_LINES,
+    NULL_PROFILE,
+    CallbackProfiler,
+    EvalProfile,
+)
+from fiqs.query import FQuery
+from fiqs.testing.gen_output import gen_output
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import StubClient, get_search, output_client
+from fiqs.tests.conftest import load_output
+
+
+def _fquery(output, **kwargs):
+    client = output_client(output)
+    return FQuery(get_search(client=client), **kwargs).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(1, 13)),
+        Sale.payment_type,
+    )
+
+
+def test_eval_profile_phases_are_exclusive(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(profiling.time, 'perf_counter', lambda: now[0])
+
+    profile = EvalProfile()
+    with profile.phase(FLATTEN):
+        now[0] += 1
+        with profile.phase(CASTING):
+            now[0] += 2
+        now[0] += 3
+        with profile.phase(CASTING):
+            now[0] += 4
+
+    assert profile.timings == {FLATTEN: 4, CASTING: 6}
+    assert profile.total_time == 10
+
+
+def test_eval_profile_count_response():
+    output = load_output('total_sales_by_payment_type_by_shop')
+
+    profile = EvalProfile()
+    profile.count_response(output)
+
+    # 3 payment types, 10 shops each
+    assert profile.counts['nb_buckets'] == 3 + 3 * 10
+    assert 'response_bytes_estimate' not in profile.counts
+
+    profile = EvalProfile(measure_response_size=True)
+    profile.count_response(output)
+    assert profile.counts['response_bytes_estimate'] > 0
+
+
+@pytest.mark.parametrize('format', ['lines', 'columns', 'rows'])
+def test_eval_with_profiler(format):
+    if format == 'columns':
+        pytest.importorskip('numpy')
+
+    output = load_output('total_sales_by_payment_type_by_shop')
+    profiles = []
+    fquery = _fquery(output, profiler=CallbackProfiler(
+        lambda fquery, profile: profiles.append(profile)))
+
+    fquery.eval(format=format)
+    assert len(profiles) == 1
+
+    profile = profiles[0]
+    for phase in (CONFIGURE_SEARCH, EXECUTE, FLATTEN, CASTING,
+                  MISSING_LINES):
+        assert profile.timings[phase] >= 0
+
+    # 12 shops by payment type, 2 of them are missing
+    assert profile.counts['nb_lines'] == 3 * 12
+    assert profile.counts['nb_missing_lines'] == 3 * 2
+    assert profile.counts['nb_buckets'] == 3 + 3 * 10
+
+    # The query does not keep the profile around
+    assert fquery._profile is NULL_PROFILE
+
+
+def test_eval_computed_fields_phase():
+    group_by = [Sale.shop_id, Sale.payment_type]
+    fquery = FQuery(None).values(
+        ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+    ).group_by(*group_by)
+    output = gen_output(fquery, seed=1)
+
+    client = StubClient(lambda body: output)
+    fquery = FQuery(get_search(client=client)).values(
+        ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+    ).group_by(*group_by)
+
+    with profiling.profile(fquery) as profiles:
+        fquery.eval(fill_missing_buckets=False)
+
+    assert COMPUTED_FIELDS in profiles[0].timings
+    assert MISSING_LINES not in profiles[0].timings
+    assert fquery.profiler is None
+
+
+def test_eval_default_profiler():
+    output = load_output('total_sales_by_payment_type_by_shop')
+
+    with profiling.profile() as profiles:
+        _fquery(output).eval()
+        _fquery(output).eval(limit=5)
+
+    assert [profile.counts['nb_lines'] for profile in profiles] == [36, 5]
+    assert profiling.get_default_profiler() is None
+
+    # Not recorded anymore
+    _fquery(output).eval()
+    assert len(profiles) == 2
+
+
+def test_eval_measure_response_size():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    fquery = _fquery(output)
+
+    with profiling.profile(fquery) as profiles:
+        fquery.eval()
+    assert 'response_bytes_estimate' not in profiles[0].counts
+
+    with profiling.profile(fquery, measure_response_size=True) as profiles:
+        fquery.eval()
+    assert profiles[0].counts['response_bytes_estimate'] > 0
@@ -2,9 +2,11 @@
 
 from collections import Counter
 from datetime import datetime
+from itertools import islice
 
 import pytest
 
+from fiqs import flatten_result
 from fiqs.aggregations import (
     Addition,
     Avg,
@@ -27,10 +29,11 @@ from fiqs.fields import (
     IntegerField,
 )
 from fiqs.models import Model
-from fiqs.query import FQuery
+from fiqs.query import FQuery, compiled_aggregations
 from fiqs.testing.models import Sale, TrafficCount
-from fiqs.testing.utils import get_search
-from fiqs.tests.conftest import load_output
+from fiqs.testing.utils import StubClient, get_search, output_client
+from fiqs.tests.conftest import load_output, total_sales_by_shop_fquery
+from fiqs.tree import BUCKET_LEVEL, NESTED_LEVEL
 
 
 def test_one_metric():
@@ -267,6 +270,159 @@ def test_date_histogram():
     assert search.to_dict() == fsearch.to_dict()
 
 
+def test_configure_search_twice():
+    output = load_output('total_sales_day_by_day')
+    client = output_client(output)
+    fquery = FQuery(get_search(client=client)).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 31),
+        ),
+    )
+
+    assert fquery.eval() == fquery.eval()
+
+    # The extended bounds are still there, and the search is left untouched
+    assert len(client.bodies) == 2
+    assert client.bodies[0] == client.bodies[1]
+    assert client.bodies[1]['aggs']['timestamp']['date_histogram'][
+        'extended_bounds'] == {
+            'min': datetime(2016, 1, 1),
+            'max': datetime(2016, 1, 31),
+        }
+    assert fquery.search.to_dict() == {}
+
+
+def test_configure_search_compiled_once(monkeypatch):
+    def fquery(order_by, choices=None, dense_choices=False):
+        shop_id = Sale.shop_id
+        if choices is not None:
+            shop_id = FieldWithChoices(shop_id, choices=choices)
+
+        return FQuery(get_search(), dense_choices=dense_choices).values(
+            total_sales=Sum(Sale.price),
+        ).group_by(
+            shop_id,
+        ).order_by(order_by)
+
+    compiled_aggregations.clear()
+    expected = fquery({'total_sales': 'desc'})._configure_search().to_dict()
+    assert len(compiled_aggregations) == 1
+
+    # The same definition does not build the aggregations again
+    monkeypatch.setattr(
+        FQuery, '_configure_values', lambda self, agg: 1 / 0)
+    monkeypatch.setattr(
+        FQuery, '_get_aggregations_params', lambda self, max_size: 1 / 0)
+    search = fquery({'total_sales': 'desc'})._configure_search()
+    assert search.to_dict() == expected
+
+    # Each search gets its own body
+    search.to_dict()['aggs']['shop_id']['terms']['field'] = 'client_id'
+    assert fquery({'total_sales': 'desc'})._configure_search().to_dict() ==\
+        expected
+
+    monkeypatch.undo()
+    fquery({'total_sales': 'asc'})._configure_search()
+    assert len(compiled_aggregations) == 2
+
+    # The choices of the fields are part of the definition
+    order_by = {'total_sales': 'desc'}
+    fquery(order_by, choices=[1, 2])._configure_search()
+    search = fquery(
+        order_by, choices=[1, 2], dense_choices=True)._configure_search()
+    assert len(compiled_aggregations) == 4
+    assert search.to_dict()['aggs']['shop_id']['terms']['include'] == [1, 2]
+
+
+def test_configure_search_keeps_search_aggregations():
+    search = get_search()
+    search.aggs.metric('nb_clients', 'cardinality', field='client_id')
+
+    fquery = FQuery(search).values(
+        total_sales=Sum(Sale.price),
+    )
+
+    assert fquery._configure_search().to_dict() == {
+        'aggs': {
+            'nb_clients': {'cardinality': {'field': 'client_id'}},
+            'total_sales': {'sum': {'field': 'price'}},
+        },
+    }
+
+
+def _with_search_aggregation(output):
+    # Adds the response of an aggregation already on the search
+    payment_types = load_output('total_sales_by_payment_type')[
+        'aggregations']['payment_type']
+    for bucket in payment_types['buckets']:
+        bucket.pop('total_sales')
+    output['aggregations']['payment_type'] = payment_types
+
+    search = get_search(client=output_client(output))
+    search.aggs.bucket('payment_type', 'terms', field='payment_type')
+    return search
+
+
+def test_eval_keeps_search_aggregations():
+    output = load_output('total_sales_by_shop')
+    search = _with_search_aggregation(output)
+    fquery = FQuery(search).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+    )
+
+    lines = fquery.eval(fill_missing_buckets=False)
+
+    assert lines == flatten_result(output)
+    assert [line['payment_type'] for line in lines[:3]] ==\
+        ['wire_transfer', 'store_credit', 'cash']
+    assert len(lines) == 3 + 10
+
+
+def test_eval_columns_keeps_search_aggregations():
+    pytest.importorskip('numpy')
+
+    output = load_output('total_sales_by_shop')
+    search = _with_search_aggregation(output)
+    fquery = FQuery(search).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+    )
+
+    # No fast path, the lines of the other aggregation are needed
+    assert fquery._single_level_columns(search.execute()) is None
+
+    columns = fquery.eval(format='columns', fill_missing_buckets=False)
+    assert len(columns['doc_count']) == 3 + 10
+    assert list(columns['payment_type'][:3]) ==\
+        ['wire_transfer', 'store_credit', 'cash']
+
+
+def test_eval_not_flat_typed_aggregations():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output)
+    fquery = FQuery(get_search(client=client)).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+    )
+
+    result = fquery.eval(flat=False)
+
+    bucket = result.aggregations.shop_id.buckets[0]
+    assert bucket.key == output['aggregations']['shop_id']['buckets'][0][
+        'key']
+    assert bucket.total_sales.value == output['aggregations']['shop_id'][
+        'buckets'][0]['total_sales']['value']
+
+
 def test_date_histogram_month():
     start = datetime(2016, 1, 1)
     end = datetime(2016, 6, 1)
@@ -1176,6 +1332,58 @@ def test_flatten_result_histogram():
         [line['price'] for line in lines]) == list(range(0, 1100, 100))
 
 
+def test_flatten_single_level_matches_generic_flattening():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+        avg_sales=Avg(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+        ),
+    )
+
+    result = load_output('total_sales_day_by_day')
+    for bucket in result['aggregations']['timestamp']['buckets']:
+        bucket['avg_sales'] = {'value': bucket['total_sales']['value'] / 3.}
+
+    lines = fquery._flatten_single_level(result)
+    assert len(lines) == 31
+    assert lines == list(fquery._iter_flatten_result(result))
+
+
+def test_flatten_single_level_not_used():
+    # Two levels of buckets
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        Sale.shop_id,
+    )
+    result = load_output('total_sales_by_payment_type_by_shop')
+    assert fquery._flatten_single_level(result) is None
+
+    # Keyed buckets
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+    ).group_by(
+        FieldWithRanges(Sale.price, ranges=[(0, 500), (500, 1000)]),
+    )
+    assert fquery._flatten_single_level({
+        'aggregations': {'price': {'buckets': {}}}}) is None
+
+    # The result does not match the query
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+    )
+    result = load_output('total_sales_by_shop')
+    for bucket in result['aggregations']['shop_id']['buckets']:
+        bucket.pop('total_sales')
+    assert fquery._flatten_single_level(result) is None
+
+
 def test_computed_field():
     computed_field = Addition(
         Sum(TrafficCount.incoming_traffic),
@@ -1583,6 +1791,57 @@ def test_flatten_result_grouped_field_with_metric():
         assert type(line['shop_id']) == str
 
 
+def test_flatten_plan():
+    fquery = FQuery(get_search()).values(
+        ReverseNested(
+            Sale,
+            avg_sales=Avg(Sale.price),
+            total_sales=Sum(Sale.price),
+        ),
+        avg_part_price=Avg(Sale.part_price),
+    ).group_by(
+        Sale.product_type,
+        Sale.part_id,
+    )
+
+    plan = fquery._get_flatten_plan()
+    assert plan.levels == [
+        (NESTED_LEVEL, 'products'),
+        (BUCKET_LEVEL, 'product_type'),
+        (NESTED_LEVEL, 'parts'),
+        (BUCKET_LEVEL, 'part_id'),
+    ]
+    assert plan.metric_keys == ['avg_part_price']
+    assert plan.reverse_nested == {
+        'reverse_nested_root': ['avg_sales', 'total_sales'],
+    }
+
+    # The plan is computed once
+    assert fquery._get_flatten_plan() is plan
+
+    # Unless the query changes
+    fquery.values(Count(Sale))
+    assert fquery._get_flatten_plan() is not plan
+
+
+def test_iter_flatten_result():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.shop_id,
+    )
+
+    result = load_output('total_sales_by_shop')
+    lines = fquery._iter_flatten_result(result)
+
+    # Lines are yielded one by one
+    first_line = next(lines)
+    assert type(first_line['shop_id']) == int
+    assert type(first_line['total_sales']) == int
+
+    assert [first_line] + list(lines) == fquery._flatten_result(result)
+
+
 ########################
 # Fill missing buckets #
 ########################
@@ -2242,3 +2501,455 @@ def test_fill_missing_buckets_grouped_field_2():
 
     lines = fquery._add_missing_lines(lines)
     assert len(lines) == 6  # 3 payment types, 2 groups
+
+
+def test_iter_with_missing_lines():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(1, 11)),
+    )
+
+    result = load_output('total_sales_by_shop')
+    result['aggregations']['shop_id']['buckets'] = [
+        bucket for bucket in result['aggregations']['shop_id']['buckets']
+        if bucket['key'] != 1
+    ]
+
+    lines = list(fquery._iter_with_missing_lines(
+        fquery._iter_flatten_result(result)))
+    assert len(lines) == 10
+
+    # The missing line comes last
+    assert lines[:9] == fquery._flatten_result(result)
+    assert lines[9] == {
+        'shop_id': 1,
+        'total_sales': None,
+        'doc_count': 0,
+    }
+
+
+def test_iter_missing_lines_is_lazy():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(10 ** 4)),
+        FieldWithChoices(Sale.client_id, choices=range(10 ** 4)),
+        Sale.payment_type,
+    )
+
+    group_by_keys = ['shop_id', 'client_id', 'payment_type']
+    existing_keys = {(0, 0, 'wire_transfer'), (0, 1, 'cash')}
+    missing_lines = fquery._iter_missing_lines(
+        existing_keys, len(existing_keys), group_by_keys)
+
+    # The 3 * 10 ** 8 keys are not built to get the first lines
+    assert list(islice(missing_lines, 3)) == [
+        {
+            'shop_id': 0,
+            'client_id': 0,
+            'payment_type': payment_type,
+            'total_sales': None,
+            'doc_count': 0,
+        } for payment_type in ['cash', 'store_credit']
+    ] + [{
+        'shop_id': 0,
+        'client_id': 1,
+        'payment_type': 'wire_transfer',
+        'total_sales': None,
+        'doc_count': 0,
+    }]
+
+
+def test_missing_lines_keys_are_typed():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.client_id, choices=['1', '2', '3']),
+    )
+
+    lines = [
+        {'client_id': '1', 'total_sales': 10, 'doc_count': 1},
+        {'client_id': 2, 'total_sales': 20, 'doc_count': 2},
+    ]
+
+    # The integer key is not the '2' choice
+    assert fquery._get_missing_lines(lines) == [
+        {'client_id': '2', 'total_sales': None, 'doc_count': 0},
+        {'client_id': '3', 'total_sales': None, 'doc_count': 0},
+    ]
+
+
+def _shop_by_day_fquery(**kwargs):
+    return FQuery(get_search(), **kwargs).values(
+        Count(Sale),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=[1, 2, 3]),
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 3),
+        ),
+    )
+
+
+def test_missing_lines_complete_levels(monkeypatch):
+    fquery = _shop_by_day_fquery()
+
+    # Elasticsearch returned all the days of the shops it returned,
+    # its keys are not those we expect
+    days = [datetime(2015, 12, 31, 23), datetime(2016, 1, 1, 23),
+            datetime(2016, 1, 2, 23)]
+    lines = [
+        {'shop_id': shop_id, 'timestamp': day, 'doc_count': 1}
+        for shop_id in [1, 3] for day in days
+    ]
+
+    missing_lines = fquery._get_missing_lines(lines)
+    assert missing_lines == [
+        {'shop_id': 2, 'timestamp': day, 'doc_count': 0} for day in days
+    ]
+
+    # The days of the returned shops are not looked at
+    checked_keys = []
+    iter_missing_keys = fquery._iter_missing_keys
+
+    def spy(prefix, *args):
+        checked_keys.append(prefix)
+        return iter_missing_keys(prefix, *args)
+
+    monkeypatch.setattr(fquery, '_iter_missing_keys', spy)
+    assert fquery._get_missing_lines(lines) == missing_lines
+    assert checked_keys == [(), (1,), (3,)]
+
+
+def test_missing_lines_incomplete_levels():
+    fquery = _shop_by_day_fquery()
+
+    # The response is missing a bucket between the bounds of the histogram
+    days = [datetime(2016, 1, 1), datetime(2016, 1, 2), datetime(2016, 1, 3)]
+    lines = [
+        {'shop_id': shop_id, 'timestamp': day, 'doc_count': 1}
+        for shop_id in [1, 2, 3] for day in days
+        if (shop_id, day) != (2, days[1])
+    ]
+
+    assert fquery._get_missing_lines(lines) == [
+        {'shop_id': 2, 'timestamp': days[1], 'doc_count': 0},
+    ]
+
+
+def test_dense_choices():
+    fquery = FQuery(get_search(), default_size=2, dense_choices=True).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        FieldWithChoices(Sale.shop_id, choices=range(1, 11)),
+        Sale.payment_type,
+    )
+
+    search = fquery._configure_search()
+    shop_agg = search.to_dict()['aggs']['shop_id']['terms']
+    assert shop_agg['include'] == list(range(1, 11))
+    assert shop_agg['min_doc_count'] == 0
+    assert shop_agg['size'] == 10
+
+    # Fields with choices are filtered by Elasticsearch
+    payment_type_agg = search.to_dict()['aggs']['shop_id'][
+        'aggs']['payment_type']['terms']
+    assert payment_type_agg['include'] ==\
+        ['wire_transfer', 'cash', 'store_credit']
+
+    # Nothing is missing if Elasticsearch returned all the choices
+    lines = [
+        {'shop_id': shop_id, 'payment_type': payment_type}
+        for shop_id in range(1, 11)
+        for payment_type in ['cash', 'store_credit', 'wire_transfer']
+    ]
+    existing_prefixes = [
+        set((line['shop_id'],) for line in lines),
+        set((line['shop_id'], line['payment_type']) for line in lines),
+    ]
+    enums = fquery._get_field_enums(existing_prefixes[-1])
+    assert fquery._get_complete_levels(enums, existing_prefixes) ==\
+        [True, True]
+
+    # Not without the option
+    fquery.dense_choices = False
+    assert 'include' not in fquery._configure_search().to_dict()[
+        'aggs']['shop_id']['terms']
+    assert fquery._get_complete_levels(enums, existing_prefixes) ==\
+        [False, False]
+
+
+def _composite_search_func(output, metric_keys):
+    # metric_keys maps the metrics of the buckets to the keys of the lines
+    # Fakes Elasticsearch composite aggregations, from a recorded output
+    def search_func(body):
+        params = body['aggs']['composite']['composite']
+        keys = [list(source.keys())[0] for source in params['sources']]
+
+        buckets = []
+        for line in flatten_result(output):
+            bucket = {
+                'key': {key: line[key] for key in keys},
+                'doc_count': line['doc_count'],
+            }
+            for metric_key, line_key in metric_keys.items():
+                bucket[metric_key] = {'value': line[line_key]}
+            buckets.append(bucket)
+
+        def sort_key(bucket):
+            return [bucket['key'][key] for key in keys]
+
+        buckets.sort(key=sort_key)
+        if 'after' in params:
+            after = [params['after'][key] for key in keys]
+            buckets = [b for b in buckets if sort_key(b) > after]
+
+        buckets = buckets[:params['size']]
+        node = {'buckets': buckets}
+        if buckets:
+            node['after_key'] = buckets[-1]['key']
+
+        return {'aggregations': {'composite': node}}
+
+    return search_func
+
+
+def test_iter_composite():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    client = StubClient(_composite_search_func(
+        output, {'total_sales': 'total_sales'}))
+    fquery = FQuery(get_search(client=client)).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        Sale.shop_id,
+    )
+
+    lines = list(fquery.iter_composite(page_size=7))
+
+    # Same lines as eval, sorted by their keys
+    expected = fquery._flatten_result(output)
+    assert len(lines) == len(expected) == 30
+    assert sorted(lines, key=lambda line: str(line)) ==\
+        sorted(expected, key=lambda line: str(line))
+    assert lines == sorted(
+        lines, key=lambda line: (line['payment_type'], line['shop_id']))
+
+    # 30 lines, 7 by page
+    assert len(client.bodies) == 5
+    assert client.bodies[0] == {
+        'from': 0,
+        'size': 0,
+        'aggs': {
+            'composite': {
+                'composite': {
+                    'sources': [
+                        {'payment_type': {
+                            'terms': {'field': 'payment_type'}}},
+                        {'shop_id': {'terms': {'field': 'shop_id'}}},
+                    ],
+                    'size': 7,
+                },
+                'aggs': {
+                    'total_sales': {'sum': {'field': 'price'}},
+                },
+            },
+        },
+    }
+    assert client.bodies[1]['aggs']['composite']['composite']['after'] == {
+        'payment_type': lines[6]['payment_type'],
+        'shop_id': lines[6]['shop_id'],
+    }
+
+    # The search of the query is left untouched
+    assert fquery.search.to_dict() == {}
+
+
+def test_iter_composite_computed_fields():
+    output = load_output('total_sales_by_shop')
+    client = StubClient(_composite_search_func(
+        output, {'sale__price__sum': 'total_sales'}))
+    fquery = FQuery(get_search(client=client)).values(
+        Sum(Sale.price),
+        avg_sale=Ratio(Sum(Sale.price), Count(Sale)),
+    ).group_by(
+        Sale.shop_id,
+    )
+
+    lines = list(fquery.iter_composite())
+    assert len(lines) == 10
+
+    for line in lines:
+        assert type(line['sale__price__sum']) == int
+        # Ratios are percentages
+        assert line['avg_sale'] ==\
+            100.0 * line['sale__price__sum'] / line['doc_count']
+
+
+def test_iter_composite_date_histogram():
+    output = load_output('total_sales_day_by_day')
+    client = StubClient(_composite_search_func(
+        output, {'total_sales': 'total_sales'}))
+    fquery = FQuery(get_search(client=client)).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        DateHistogram(
+            Sale.timestamp,
+            interval='1d',
+            min=datetime(2016, 1, 1),
+            max=datetime(2016, 1, 31),
+        ),
+    )
+
+    lines = list(fquery.iter_composite())
+    assert lines == fquery._flatten_result(output)
+
+    sources = client.bodies[0]['aggs']['composite']['composite']['sources']
+    assert sources == [{
+        'timestamp': {
+            'date_histogram': {'field': 'timestamp', 'interval': '1d'},
+        },
+    }]
+
+
+def test_iter_composite_missing_buckets():
+    output = load_output('total_sales_day_by_day')
+    buckets = output['aggregations']['timestamp']['buckets']
+    output['aggregations']['timestamp']['buckets'] = buckets[3:6]
+
+    def fquery(client):
+        return FQuery(get_search(client=client)).values(
+            total_sales=Sum(Sale.price),
+        ).group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval='1d',
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+            ),
+        )
+
+    client = StubClient(_composite_search_func(
+        output, {'total_sales': 'total_sales'}))
+    lines = list(fquery(client).iter_composite())
+
+    expected = fquery(
+        output_client(output)).eval()
+    assert len(expected) == 31
+
+    def key(line):
+        return line['timestamp']
+
+    assert sorted(lines, key=key) == sorted(expected, key=key)
+
+
+def test_iter_composite_unsupported_group_by():
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+    ).group_by(
+        FieldWithRanges(Sale.price, ranges=[(0, 500), (500, 1000)]),
+    )
+
+    with pytest.raises(ConfigurationError):
+        fquery.iter_composite()
+
+    fquery = FQuery(get_search()).values(
+        Count(Sale),
+    ).group_by(
+        Sale.product_type,
+    )
+
+    with pytest.raises(ConfigurationError):
+        fquery.iter_composite()
+
+
+@pytest.mark.parametrize('limit,offset', [
+    (3, 0),
+    (3, 4),
+    (5, 8),
+    (None, 9),
+    (20, 0),
+    (0, 0),
+])
+def test_eval_limit_offset(limit, offset):
+    output = load_output('total_sales_by_shop')
+    fquery = total_sales_by_shop_fquery(output_client(output))
+    # 10 shops, and two missing shops
+    expected = fquery.eval()
+    assert len(expected) == 12
+
+    fquery = total_sales_by_shop_fquery(output_client(output))
+    lines = fquery.eval(limit=limit, offset=offset)
+
+    stop = offset + limit if limit is not None else None
+    assert lines == expected[offset:stop]
+
+    fquery = total_sales_by_shop_fquery(output_client(output))
+    rows = fquery.eval(limit=limit, offset=offset, format='rows')
+    assert [dict(row) for row in rows] == expected[offset:stop]
+
+
+def test_eval_limit_stops_early(monkeypatch):
+    output = load_output('total_sales_by_shop')
+    fquery = total_sales_by_shop_fquery(output_client(output))
+
+    def get_missing_lines(lines):
+        raise AssertionError('missing lines are not needed')
+
+    monkeypatch.setattr(fquery, '_get_missing_lines', get_missing_lines)
+    monkeypatch.setattr(fquery, '_iter_missing_lines', get_missing_lines)
+    assert len(fquery.eval(limit=5, offset=3)) == 5
+
+
+def test_eval_unknown_format():
+    output = load_output('total_sales_by_shop')
+    client = output_client(output)
+    fquery = total_sales_by_shop_fquery(client)
+
+    with pytest.raises(ConfigurationError):
+        fquery.eval(format='dataframe')
+
+    # Elasticsearch was not called
+    assert client.bodies == []
+
+
+def test_eval_limit_pushed_to_size():
+    output = load_output('total_sales_by_shop')
+
+    client = output_client(output)
+    fquery = total_sales_by_shop_fquery(client, default_size=50)
+    fquery.eval(limit=5, offset=3)
+    assert client.bodies[0]['aggs']['shop_id']['terms']['size'] == 8
+
+    # We never ask for more buckets than without limit
+    client = output_client(output)
+    fquery = total_sales_by_shop_fquery(client, default_size=50)
+    fquery.eval(limit=100)
+    assert client.bodies[0]['aggs']['shop_id']['terms']['size'] == 50
+
+    # The others line needs all the buckets
+    client = output_client(output)
+    fquery = total_sales_by_shop_fquery(client, default_size=50)
+    fquery.eval(limit=5, add_others_line=True)
+    assert client.bodies[0]['aggs']['shop_id']['terms']['size'] == 50
+
+
+def test_eval_limit_not_pushed_with_several_group_by():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    client = output_client(output)
+    fquery = FQuery(get_search(client=client), default_size=50).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        Sale.shop_id,
+    )
+
+    lines = fquery.eval(limit=4)
+    assert len(lines) == 4
+
+    aggs = client.bodies[0]['aggs']
+    assert aggs['payment_type']['terms']['size'] == 50
+    assert aggs['payment_type']['aggs']['shop_id']['terms']['size'] == 50
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+import pytest
+
+from fiqs import flatten_raw, flatten_result
+from fiqs.exceptions import ConfigurationError
+from fiqs.tests.conftest import load_output
+
+pytest.importorskip('ijson')
+
+
+def _es_ordered(node):
+    # Elasticsearch writes the buckets of an aggregation last,
+    # after their sum_other_doc_count
+    if isinstance(node, list):
+        return [_es_ordered(child) for child in node]
+    if not isinstance(node, dict):
+        return node
+
+    ordered = {k: _es_ordered(v) for k, v in node.items() if k != 'buckets'}
+    if 'buckets' in node:
+        ordered['buckets'] = _es_ordered(node['buckets'])
+    return ordered
+
+
+def _sorted_lines(lines):
+    return sorted(lines, key=lambda line: sorted(line.items(), key=str))
+
+
+@pytest.mark.parametrize('name', [
+    'avg_part_price_by_product_and_by_part',
+    'avg_part_price_by_shop_range_by_part_id',
+    'nb_sales_by_grouped_shop_by_payment_type',
+    'nb_sales_by_product_type_by_part_id_filter_product_type_1',
+    'nb_sales_by_shop_by_payment_type_limited_size',
+    'no_data_nb_sales_by_day_of_week_by_shop',
+    'total_and_avg_sales_by_product_type',
+    'total_sales_and_avg_sales',
+])
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'add_others_line': True},
+    {'remove_nested_aggregations': False},
+])
+def test_flatten_raw_same_lines(name, kwargs):
+    result = load_output(name)
+    raw = json.dumps(_es_ordered(result)).encode('utf-8')
+
+    assert list(flatten_raw(raw, **kwargs)) ==\
+        flatten_result(result, **kwargs)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'add_others_line': True},
+])
+def test_flatten_raw_sibling_aggregations(kwargs):
+    result = load_output('total_sales_day_by_day_by_shop_and_by_payment')
+    raw = json.dumps(_es_ordered(result)).encode('utf-8')
+    lines = list(flatten_raw(raw, **kwargs))
+
+    # Sibling aggregations are flattened in the order of the response
+    assert lines != flatten_result(result, **kwargs)
+    assert _sorted_lines(lines) == _sorted_lines(
+        flatten_result(result, **kwargs))
+
+
+def test_flatten_raw_keyed_buckets_order():
+    raw = b'''{
+        "aggregations": {
+            "shop_id": {
+                "buckets": {
+                    "b": {"doc_count": 2},
+                    "a": {"doc_count": 1}
+                }
+            }
+        }
+    }'''
+
+    assert list(flatten_raw(raw)) == [
+        {'shop_id': 'a', 'doc_count': 1},
+        {'shop_id': 'b', 'doc_count': 2},
+    ]
+
+
+def test_flatten_raw_others_line_after_buckets():
+    result = load_output('nb_sales_by_shop_by_payment_type_limited_size')
+    lines = flatten_result(result, add_others_line=True)
+
+    # The count of the other buckets comes after the buckets,
+    # so does the others line
+    raw = json.dumps(result, sort_keys=True).encode('utf-8')
+    raw_lines = list(flatten_raw(raw, add_others_line=True))
+    assert raw_lines[-1] == lines[0] == {'shop_id': 'others', 'doc_count': 776}
+    assert _sorted_lines(raw_lines) == _sorted_lines(lines)
+
+
+def test_flatten_raw_no_aggregations():
+    assert list(flatten_raw(b'{"hits": {"hits": [{"a": 1}]}}')) == []
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'output': 'columns'},
+    {'workers': 2},
+    {'single_pass': False},
+])
+def test_flatten_raw_unsupported_arguments(kwargs):
+    raw = json.dumps(load_output('total_sales_by_shop'))
+    with pytest.raises(ConfigurationError):
+        flatten_raw(raw, **kwargs)
+
+
+def test_flatten_raw_key_after_aggregation():
+    # The shop key is only known once its client_id buckets are read
+    raw = b'''{
+        "aggregations": {
+            "shop_id": {
+                "buckets": [
+                    {
+                        "client_id": {
+                            "buckets": [
+                                {"key": "client_1", "doc_count": 2},
+                                {"key": "client_2", "doc_count": 1}
+                            ]
+                        },
+                        "doc_count": 3,
+                        "key": 1
+                    }
+                ]
+            }
+        }
+    }'''
+
+    assert list(flatten_raw(raw)) == [
+        {'shop_id': 1, 'client_id': 'client_1', 'doc_count': 2},
+        {'shop_id': 1, 'client_id': 'client_2', 'doc_count': 1},
+    ]
+
+
+def test_flatten_raw_is_incremental():
+    result = {
+        'aggregations': {
+            'shop_id': {
+                'buckets': [
+                    {'key': idx, 'doc_count': idx}
+                    for idx in range(100000)
+                ],
+            },
+        },
+    }
+    raw = io.BytesIO(json.dumps(result).encode('utf-8'))
+    lines = flatten_raw(raw)
+
+    assert next(lines) == {'shop_id': 0, 'doc_count': 0}
+    # We did not need to read the whole response to get the first line
+    assert raw.tell() < len(raw.getvalue())
+
+    assert len(list(lines)) == 100000 - 1
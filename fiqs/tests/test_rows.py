@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import sys
+
+from fiqs.aggregations import Avg, Count, ReverseNested, Sum
+from fiqs.query import FQuery
+from fiqs.rows import make_row_class
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import load_output
+
+
+def test_row():
+    row_class = make_row_class(['shop_id', 'doc_count', 'total_sales'])
+    row = row_class.from_line({'shop_id': 1, 'doc_count': 10})
+
+    assert row['shop_id'] == 1
+    assert row['doc_count'] == 10
+    assert row['total_sales'] is None
+    assert row.get('client_id') is None
+
+    assert 'shop_id' in row
+    assert 'client_id' not in row
+    assert list(row.keys()) == ['shop_id', 'doc_count', 'total_sales']
+
+    assert dict(row) == {'shop_id': 1, 'doc_count': 10, 'total_sales': None}
+    assert row == {'shop_id': 1, 'doc_count': 10, 'total_sales': None}
+
+
+def test_row_class_is_shared():
+    columns = ['shop_id', 'doc_count']
+    row_class = make_row_class(columns)
+    assert make_row_class(columns) is row_class
+
+    row = row_class.from_line({'shop_id': 1, 'doc_count': 10})
+    # No dict on the rows, keys are stored on the class
+    assert not hasattr(row, '__dict__')
+    assert sys.getsizeof(row) < sys.getsizeof(dict(row))
+
+
+def test_row_pickle():
+    row_class = make_row_class(['shop_id', 'doc_count'])
+    row = row_class.from_line({'shop_id': 1, 'doc_count': 10})
+
+    unpickled_row = pickle.loads(pickle.dumps(row))
+    assert unpickled_row == row
+    assert type(unpickled_row) is row_class
+
+
+def test_fquery_row_class():
+    fquery = FQuery(get_search()).values(
+        ReverseNested(
+            Sale,
+            avg_sales=Avg(Sale.price),
+        ),
+        Count(Sale),
+        total_sales=Sum(Sale.product_price),
+    ).group_by(
+        Sale.product_type,
+    )
+
+    row_class = fquery._get_row_class()
+    assert row_class._columns == (
+        'product_type',
+        'reverse_nested_root__avg_sales',
+        'reverse_nested_root__doc_count',
+        'doc_count',
+        'total_sales',
+    )
+
+
+def test_fquery_rows():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    ).group_by(
+        Sale.payment_type,
+        Sale.shop_id,
+    )
+
+    result = load_output('total_sales_by_payment_type_by_shop')
+    lines = fquery._flatten_result(result)
+
+    row_class = fquery._get_row_class()
+    rows = [row_class.from_line(line) for line in lines]
+    assert rows == lines
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import tracemalloc
+
 import pytest
 
-from fiqs import flatten_result
+from fiqs import flatten_result, iter_lines
+from fiqs.exceptions import ConfigurationError
 from fiqs.tests.conftest import load_output
-from fiqs.tree import ResultTree
+from fiqs.tree import (
+    BUCKET_LEVEL,
+    NESTED_LEVEL,
+    FlattenPlan,
+    ResultTree,
+    count_buckets,
+    estimate_nb_buckets,
+)
 
 
 def test_no_aggregate_no_metric():
@@ -824,6 +834,42 @@ def test_is_nested_node_filters_aggregation_2():
         node['payment_type']['buckets'][0]['shop_id']['buckets']['group_a'])
 
 
+def test_is_nested_node_classifies_each_node_once():
+    node = {
+        'doc_count': 10,
+        'parts': {
+            'doc_count': 20,
+            'subparts': {
+                'doc_count': 30,
+                'subpart_id': {
+                    'buckets': [],
+                },
+            },
+        },
+    }
+
+    tree = ResultTree({})
+    classified_nodes = []
+    classify_node = tree._classify_node
+
+    def _classify_node(node):
+        classified_nodes.append(node)
+        return classify_node(node)
+
+    tree._classify_node = _classify_node
+
+    tree._remove_nested_aggregations({'products': node})
+
+    # products and parts have nested children, they are classified once.
+    # The other nodes are cheap to classify, they are not memoized.
+    assert len(set(id(n) for n in classified_nodes)) == 4
+    assert [id(n) for n in classified_nodes].count(id(node)) == 1
+    assert [id(n) for n in classified_nodes].count(id(node['parts'])) == 1
+
+    # The nodes are not kept once the aggregations are walked
+    assert tree._nested_nodes == {}
+
+
 def test_remove_nested_aggregations():
     node = {
         "products": {
@@ -1689,15 +1735,18 @@ def test_avg_sales_by_grouped_shop():
         assert type(line['shop_id']) == str
 
 
-@pytest.mark.xfail
 def test_avg_price_filter_shop_id_1():
-    flatten_result(load_output('avg_price_filter_shop_id_1'))
+    lines = flatten_result(load_output('avg_price_filter_shop_id_1'))
+
+    # The filter aggregation is a single bucket
+    assert lines == [{'avg_price': 549.6666666666666, 'doc_count': 96}]
 
 
-@pytest.mark.xfail
 def test_nb_sales_by_product_type_filter_product_type_1():
-    flatten_result(
-        load_output('nb_sales_by_product_type_filter_product_type_1'))
+    # The filter is below a nested aggregation, without any bucket
+    with pytest.raises(NotImplementedError):
+        flatten_result(
+            load_output('nb_sales_by_product_type_filter_product_type_1'))
 
 
 def test_nb_sales_by_product_type_by_part_id_filter_product_type_1():
@@ -1724,3 +1773,297 @@ def test_nb_sales_by_product_type_by_part_id_filter_product_type_1():
         assert type(line['doc_count']) == int
         assert type(line['part_id']) == str
         assert type(line['reverse_nested_root__doc_count']) == int
+
+
+###############
+# Single pass #
+###############
+
+SINGLE_PASS_OUTPUTS = [
+    'avg_part_price_by_part',
+    'avg_part_price_by_product_and_by_part',
+    'avg_part_price_by_product_by_part',
+    'avg_part_price_by_shop_range_by_part_id',
+    'avg_product_price_and_avg_sales_by_product_type',
+    'avg_product_price_by_shop_by_product_type',
+    'avg_sales_by_grouped_shop',
+    'nb_sales_by_date_range_by_payment_type',
+    'nb_sales_by_grouped_shop_by_payment_type',
+    'nb_sales_by_payment_type_by_grouped_shop',
+    'nb_sales_by_product_type_by_part_id',
+    'nb_sales_by_product_type_by_part_id_filter_product_type_1',
+    'nb_sales_by_shop',
+    'nb_sales_by_shop_by_payment_type_limited_size',
+    'no_data_nb_sales_by_day_of_week_by_shop',
+    'total_and_avg_sales_by_product_type',
+    'total_sales_and_avg_sales',
+    'total_sales_by_payment_type_by_shop_range',
+    'total_sales_by_shop_and_by_payment',
+    'total_sales_day_by_day_by_shop_and_by_payment',
+]
+
+
+@pytest.mark.parametrize('name', SINGLE_PASS_OUTPUTS)
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'add_others_line': True},
+])
+def test_single_pass_same_lines(name, kwargs):
+    expected = flatten_result(load_output(name), single_pass=False, **kwargs)
+    lines = flatten_result(load_output(name), single_pass=True, **kwargs)
+
+    assert lines == expected
+
+
+def test_single_pass_force_not_remove_nested_aggregation():
+    expected = flatten_result(
+        load_output('nb_sales_by_shop'),
+        remove_nested_aggregations=False,
+        single_pass=False,
+    )
+    lines = flatten_result(
+        load_output('nb_sales_by_shop'),
+        remove_nested_aggregations=False,
+        single_pass=True,
+    )
+
+    assert lines == expected
+
+
+def test_iter_lines():
+    result = load_output('total_sales_day_by_day_by_shop_and_by_payment')
+    lines = iter_lines(result)
+
+    # Lines are yielded one by one
+    first_line = next(lines)
+    assert 'doc_count' in first_line
+
+    assert [first_line] + list(lines) == flatten_result(result)
+
+
+def test_iter_lines_memory():
+    def shop_ids():
+        return [
+            {
+                'key': shop_id,
+                'doc_count': 1,
+                'total_sales': {'value': 1.0},
+                'avg_sales': {'value': 1.0},
+                'max_sales': {'value': 1.0},
+            }
+            for shop_id in range(200)
+        ]
+
+    result = {
+        'aggregations': {
+            'day': {
+                'buckets': [
+                    {'key': day, 'doc_count': 200,
+                     'shop_id': {'buckets': shop_ids()}}
+                    for day in range(500)
+                ],
+            },
+        },
+    }
+    tree = ResultTree(result)
+
+    tracemalloc.start()
+    try:
+        nb_lines = 0
+        for _ in tree.iter_lines():
+            nb_lines += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Nothing is kept from one line to the next, whatever the result size
+    assert nb_lines == 500 * 200
+    assert tree._nested_nodes == {}
+    assert peak < 2 ** 20
+
+
+@pytest.mark.parametrize('name', [
+    'avg_part_price_by_product_and_by_part',
+    'nb_sales_by_product_type_by_part_id_filter_product_type_1',
+    'nb_sales_by_shop_by_payment_type_limited_size',
+    'total_sales_by_payment_type_by_shop_range',
+    'total_sales_day_by_day_by_shop_and_by_payment',
+])
+def test_flatten_result_does_not_modify_result(name):
+    result = load_output(name)
+
+    lines = flatten_result(result)
+    # The result is left untouched
+    assert result == load_output(name)
+
+    # So it can be flattened again, with other options
+    assert flatten_result(result) == lines
+    assert flatten_result(result, add_others_line=True) == flatten_result(
+        load_output(name), add_others_line=True, single_pass=False)
+    assert result == load_output(name)
+
+
+########
+# Plan #
+########
+
+def test_plan_avg_part_price_by_product_by_part():
+    plan = FlattenPlan(
+        levels=[
+            (NESTED_LEVEL, 'products'),
+            (BUCKET_LEVEL, 'product_id'),
+            (NESTED_LEVEL, 'parts'),
+            (BUCKET_LEVEL, 'part_id'),
+        ],
+        metric_keys=['avg_part_price'],
+    )
+    result = load_output('avg_part_price_by_product_by_part')
+    tree = ResultTree(result)
+
+    assert tree._plan_matches(result['aggregations'], plan)
+    assert tree.flatten_result(plan=plan) == flatten_result(result)
+
+
+def test_plan_other_aggregations():
+    plan = FlattenPlan(
+        levels=[(BUCKET_LEVEL, 'shop_id')],
+        metric_keys=['total_sales'],
+    )
+    result = load_output('total_sales_by_shop')
+    result['aggregations']['payment_type'] = {
+        'buckets': [{'key': 'cash', 'doc_count': 12}],
+    }
+    tree = ResultTree(result)
+
+    # The other aggregation is not part of the plan, it is not dropped
+    assert not tree._plan_matches(result['aggregations'], plan)
+    assert tree.flatten_result(plan=plan) == flatten_result(result)
+    assert {'payment_type': 'cash', 'doc_count': 12} in flatten_result(result)
+
+
+def test_plan_reverse_nested():
+    plan = FlattenPlan(
+        levels=[
+            (NESTED_LEVEL, 'products'),
+            (BUCKET_LEVEL, 'product_type'),
+        ],
+        reverse_nested={'reverse_nested_root': ['avg_sales', 'total_sales']},
+    )
+    result = load_output('total_and_avg_sales_by_product_type')
+    tree = ResultTree(result)
+
+    assert tree._plan_matches(result['aggregations'], plan)
+    assert tree.flatten_result(plan=plan) == flatten_result(result)
+
+
+def test_create_line_reverse_nested_columns():
+    tree = ResultTree({})
+    node = {
+        'doc_count': 10,
+        'reverse_nested_root': {
+            'doc_count': 4,
+            'total_sales': {'value': 12.0},
+        },
+    }
+
+    expected = {
+        'shop_id': 1,
+        'doc_count': 10,
+        'reverse_nested_root__doc_count': 4,
+        'reverse_nested_root__total_sales': 12.0,
+    }
+    assert tree._create_line({'shop_id': 1}, node) == expected
+    assert tree._create_line({'shop_id': 1}, node) == expected
+
+    # Column names are kept for the next lines
+    assert tree._reverse_nested_columns == {
+        'reverse_nested_root': {
+            'doc_count': 'reverse_nested_root__doc_count',
+            'total_sales': 'reverse_nested_root__total_sales',
+        },
+    }
+
+
+def test_plan_keyed_buckets_add_others_line():
+    plan = FlattenPlan(
+        levels=[
+            (BUCKET_LEVEL, 'shop_id'),
+            (BUCKET_LEVEL, 'payment_type'),
+        ],
+    )
+    result = load_output('nb_sales_by_grouped_shop_by_payment_type')
+    tree = ResultTree(result)
+
+    assert tree._plan_matches(result['aggregations'], plan)
+    assert tree.flatten_result(plan=plan, add_others_line=True) ==\
+        flatten_result(result, add_others_line=True)
+
+
+def test_plan_does_not_match():
+    plan = FlattenPlan(
+        levels=[
+            (BUCKET_LEVEL, 'payment_type'),
+            (BUCKET_LEVEL, 'timestamp'),
+        ],
+    )
+    result = load_output('nb_sales_by_date_range_by_payment_type')
+    tree = ResultTree(result)
+
+    assert not tree._plan_matches(result['aggregations'], plan)
+    # We fall back on the single pass engine
+    assert tree.flatten_result(plan=plan) == flatten_result(result)
+
+
+@pytest.mark.parametrize('name', SINGLE_PASS_OUTPUTS)
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'add_others_line': True},
+    {'remove_nested_aggregations': False},
+])
+def test_workers_same_lines(name, kwargs):
+    expected = flatten_result(load_output(name), **kwargs)
+    lines = flatten_result(load_output(name), workers=2, **kwargs)
+
+    assert lines == expected
+
+
+def test_workers_partitions():
+    result = load_output('total_sales_by_shop_and_by_payment')
+    partitions = ResultTree(result)._partition(2)
+
+    # Each sibling aggregation is split in its own partitions
+    keys = [list(p['aggregations'].keys())[0] for p in partitions]
+    assert len(partitions) > 2
+    assert set(keys) == {'shop_id', 'payment_type'}
+
+    # Partitions of the same aggregation follow each other
+    nb_first_partitions = keys.count(keys[0])
+    assert keys[:nb_first_partitions] == [keys[0]] * nb_first_partitions
+
+
+def test_workers_metrics_only():
+    result = load_output('total_sales_and_avg_sales')
+    assert ResultTree(result)._partition(2) is None
+    assert flatten_result(result, workers=2) == flatten_result(result)
+
+
+def test_flatten_result_unknown_output():
+    with pytest.raises(ConfigurationError):
+        flatten_result(load_output('total_sales_by_shop'), output='rows')
+
+
+def test_estimate_nb_buckets():
+    output = load_output('total_sales_by_payment_type_by_shop')
+    aggregations = output['aggregations']
+
+    # Each payment type has 10 shops
+    assert estimate_nb_buckets(aggregations) == 3 + 3 * 10
+    assert estimate_nb_buckets(aggregations) == count_buckets(aggregations)
+
+    # Only the first bucket of each level is looked at
+    payment_types = aggregations['payment_type']['buckets']
+    payment_types[1]['shop_id']['buckets'] = []
+    assert estimate_nb_buckets(aggregations) == 3 + 3 * 10
+    assert count_buckets(aggregations) == 3 + 2 * 10
+
+    assert estimate_nb_buckets(None) == 0
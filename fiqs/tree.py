@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor
+
+from fiqs.columns import lines_to_columns
+from fiqs.exceptions import ConfigurationError
+
 RESERVED_KEYS = [
     'key', 'key_as_string',
     'doc_count',
@@ -7,6 +12,96 @@ RESERVED_KEYS = [
     'to', 'to_as_string',
 ]
 
+BUCKET_LEVEL = 'bucket'
+NESTED_LEVEL = 'nested'
+
+# We split the result in a few partitions per worker, so that a worker
+# getting the largest buckets does not slow down the others
+PARTITIONS_PER_WORKER = 4
+
+
+def count_buckets(node):
+    # Number of buckets in the aggregations, at all levels
+    if not isinstance(node, dict):
+        return 0
+
+    nb_buckets = 0
+    for key, child_node in node.items():
+        if key == 'buckets':
+            buckets = child_node
+            if isinstance(buckets, dict):
+                buckets = buckets.values()
+            nb_buckets += len(buckets)
+            nb_buckets += sum(count_buckets(bucket) for bucket in buckets)
+        else:
+            nb_buckets += count_buckets(child_node)
+
+    return nb_buckets
+
+
+def estimate_nb_buckets(node):
+    # Same as count_buckets, from the first bucket of each aggregation only,
+    # as if the other buckets had as many sub buckets
+    if not isinstance(node, dict):
+        return 0
+
+    nb_buckets = 0
+    for key, child_node in node.items():
+        if key == 'buckets':
+            buckets = child_node
+            if isinstance(buckets, dict):
+                buckets = list(buckets.values())
+            if buckets:
+                nb_buckets += len(buckets) *\
+                    (1 + estimate_nb_buckets(buckets[0]))
+        else:
+            nb_buckets += estimate_nb_buckets(child_node)
+
+    return nb_buckets
+
+
+def _iter_buckets(buckets):
+    # Keyed buckets are walked in the order of their keys
+    if isinstance(buckets, dict):
+        return (
+            (bucket_key, buckets[bucket_key])
+            for bucket_key in sorted(buckets.keys())
+        )
+
+    return ((bucket['key'], bucket) for bucket in buckets)
+
+
+def _flatten_partition(partition, kwargs):
+    return ResultTree(partition).flatten_result(**kwargs)
+
+
+class FlattenPlan(object):
+    """Shape of an aggregation result, known before it is returned
+
+    `levels` is a list of `(kind, key)` tuples, from the root to the leaves,
+    where kind is either `BUCKET_LEVEL` or `NESTED_LEVEL`. `metric_keys`
+    holds the keys of the metrics found in the leaves, and `reverse_nested`
+    maps each reverse nested aggregation name to its metric keys.
+    """
+
+    def __init__(self, levels=None, metric_keys=None, reverse_nested=None):
+        self.levels = levels or []
+        self.metric_keys = metric_keys or []
+        self.reverse_nested = reverse_nested or {}
+
+        # Column names of the reverse nested metrics, computed once
+        self.reverse_nested_columns = [
+            (
+                name,
+                '{}__doc_count'.format(name),
+                [
+                    (key, '{}__{}'.format(name, key))
+                    for key in keys
+                ],
+            )
+            for name, keys in self.reverse_nested.items()
+        ]
+
 
 class ResultTree(object):
     def __init__(self, es_result):
@@ -19,22 +114,136 @@ class ResultTree(object):
                 'ResultTree expects a dict or '
                 'an elasticsearch_dsl Response object')
 
+        self._nested_nodes = {}
+        # Column names of the reverse nested metrics, by aggregation name
+        self._reverse_nested_columns = {}
+
     def flatten_result(self, **kwargs):
+        output = kwargs.pop('output', 'lines')
+        if output not in ('lines', 'columns'):
+            raise ConfigurationError(u'Unknown output: {}'.format(output))
+
+        workers = kwargs.pop('workers', None)
+
+        if workers and workers > 1:
+            lines = self._flatten_in_parallel(workers, **kwargs)
+        else:
+            lines = self.iter_lines(**kwargs)
+
+        if output == 'columns':
+            return lines_to_columns(lines)
+
+        return list(lines)
+
+    def _flatten_in_parallel(self, workers, **kwargs):
+        partitions = self._partition(workers, **kwargs)
+        if partitions is None:
+            return self.iter_lines(**kwargs)
+
+        # Partitions are flattened in their own process, and their lines
+        # are concatenated in the order of the partitions
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                _flatten_partition,
+                partitions,
+                [kwargs] * len(partitions),
+            )
+            return [line for lines in results for line in lines]
+
+    def _partition(self, workers, **kwargs):
+        # Splits the result at the first level of buckets, each partition
+        # is a result on its own. Returns None if there is nothing to split.
         if 'aggregations' not in self.es_result:
-            return []
+            return None
+
+        self.remove_nested_aggregations = kwargs.get(
+            'remove_nested_aggregations', True)
+
+        aggregations = self.es_result['aggregations']
+        node = aggregations[self._bootstrap_current_key(aggregations)]
+        if 'buckets' not in node and 'doc_count' not in node:
+            return None
+
+        aggregations = self._nested_view(aggregations, parent_is_root=True)
+        keys = self._top_level_keys(aggregations)
+
+        nb_buckets = sum(
+            len(aggregations[key].get('buckets', [])) for key in keys)
+        nb_partitions = workers * PARTITIONS_PER_WORKER
+        size = max(1, (nb_buckets + nb_partitions - 1) // nb_partitions)
+
+        partitions = []
+        for key in keys:
+            node = aggregations[key]
+            if 'buckets' not in node:
+                if 'doc_count' in node:
+                    partitions.append({'aggregations': {key: node}})
+                continue
+
+            buckets = node['buckets']
+            if isinstance(buckets, dict):
+                keyed_buckets = list(_iter_buckets(buckets))
+                chunks = [
+                    dict(keyed_buckets[idx:idx + size])
+                    for idx in range(0, len(keyed_buckets), size)
+                ]
+            else:
+                chunks = [
+                    buckets[idx:idx + size]
+                    for idx in range(0, len(buckets), size)
+                ]
+
+            for idx, chunk in enumerate(chunks or [buckets]):
+                partial_node = {'buckets': chunk}
+                # The others line comes first, with the first partition
+                if idx == 0 and 'sum_other_doc_count' in node:
+                    partial_node['sum_other_doc_count'] =\
+                        node['sum_other_doc_count']
+                partitions.append({'aggregations': {key: partial_node}})
+
+        return partitions
+
+    def iter_lines(self, **kwargs):
+        if 'aggregations' not in self.es_result:
+            return iter([])
 
         self.add_others_line = kwargs.get('add_others_line', False)
         self.remove_nested_aggregations = kwargs.get(
             'remove_nested_aggregations', True)
 
         aggregations = self.es_result['aggregations']
-        return self._extract_lines(aggregations)
+        plan = kwargs.get('plan')
+        if plan is not None and self._plan_matches(aggregations, plan):
+            return self._walk_plan(aggregations, plan)
+        if kwargs.get('single_pass', True):
+            return self._walk_lines(aggregations)
+        # The legacy engine consumes the aggregations as it goes
+        return iter(self._extract_lines(aggregations))
 
     def _is_nested_node(self, node, parent_is_root=True, same_level_keys=None):
         # Not even a node, or a list of buckets
         if not isinstance(node, dict):
             return False
 
+        # Can happen with filters aggregations
+        if same_level_keys is not None:
+            if not parent_is_root and 'doc_count' not in same_level_keys:
+                return False
+
+        # Nodes without children to classify, e.g. metrics, are cheap
+        if not any(
+                isinstance(child_node, dict) and 'doc_count' in child_node
+                for child_node in node.values()):
+            return self._classify_node(node)
+
+        # The rest only depends on the node itself, we classify it once
+        if id(node) not in self._nested_nodes:
+            # We keep a reference to the node so that its id is not reused
+            self._nested_nodes[id(node)] = (node, self._classify_node(node))
+
+        return self._nested_nodes[id(node)][1]
+
+    def _classify_node(self, node):
         # Standard aggregation
         if 'buckets' in node:
             return False
@@ -51,23 +260,20 @@ class ResultTree(object):
         if 'doc_count' not in node:
             return False
 
-        # Can happen with filters aggregations
-        if same_level_keys is not None:
-            if not parent_is_root and 'doc_count' not in same_level_keys:
-                return False
-
-        dict_child_nodes = [
-            child_node for child_node in node.values()
-            if isinstance(child_node, dict)
-        ]
+        # Children are classified before their parent
         child_keys = node.keys()
-        for child_node in dict_child_nodes:
+        for child_node in node.values():
+            if not isinstance(child_node, dict):
+                continue
+            if 'doc_count' not in child_node:
+                continue
+
             is_nested_child_node = self._is_nested_node(
                 child_node,
                 parent_is_root=False,
                 same_level_keys=child_keys,
             )
-            if 'doc_count' in child_node and not is_nested_child_node:
+            if not is_nested_child_node:
                 return False
 
         # Node like {'value': 123.456}
@@ -79,6 +285,13 @@ class ResultTree(object):
         return True
 
     def _remove_nested_aggregations(self, node, parent_is_root=True):
+        # Nodes are classified once per call, we do not keep them around
+        try:
+            return self._remove_nested_node(node, parent_is_root)
+        finally:
+            self._nested_nodes = {}
+
+    def _remove_nested_node(self, node, parent_is_root=True):
         _node = {}
 
         # We force an ordering to have a deterministic result
@@ -90,21 +303,22 @@ class ResultTree(object):
                 _node[key] = child_node
 
             elif isinstance(child_node, dict):
+                # We look up the node itself, not the list of its keys
                 if self._is_nested_node(
-                        child_node, parent_is_root, child_keys):
-                    _node.update(self._remove_nested_aggregations(
+                        child_node, parent_is_root, node):
+                    _node.update(self._remove_nested_node(
                         child_node,
                         parent_is_root=False,
                     ))
                 else:
-                    _node[key] = self._remove_nested_aggregations(
+                    _node[key] = self._remove_nested_node(
                         child_node,
                         parent_is_root=False,
                     )
 
             elif isinstance(child_node, list):
                 _node[key] = [
-                    self._remove_nested_aggregations(
+                    self._remove_nested_node(
                         gchild_node,
                         parent_is_root=False,
                     )
@@ -117,17 +331,57 @@ class ResultTree(object):
 
         return _node
 
+    def _nested_view(self, node, parent_is_root=False):
+        # Same result as `_remove_nested_aggregations`, but only for the
+        # given node, and without copying or modifying the source tree
+        if not self.remove_nested_aggregations:
+            return node
+
+        # Nodes are classified once per view, we do not keep them around:
+        # it would hold on to every bucket of the tree
+        try:
+            return self._nested_view_node(node, parent_is_root)
+        finally:
+            self._nested_nodes = {}
+
+    def _nested_view_node(self, node, parent_is_root=False):
+        _node = {}
+
+        child_keys = sorted(node.keys(), reverse=True)
+        for key in child_keys:
+            child_node = node[key]
+
+            if not key.startswith('reverse_nested')\
+                    and isinstance(child_node, dict)\
+                    and self._is_nested_node(
+                        child_node, parent_is_root, node):
+                _node.update(self._nested_view_node(child_node))
+            else:
+                _node[key] = child_node
+
+        return _node
+
     def _create_line(self, base_line, node):
         new_line = base_line.copy()
 
         for k, v in node.items():
             if k.startswith('reverse_nested'):
+                # Column names are the same for all the lines
+                columns = self._reverse_nested_columns.get(k)
+                if columns is None:
+                    columns = self._reverse_nested_columns[k] = {}
+
                 for nested_k, nested_v in v.items():
                     if isinstance(nested_v, dict):
                         value = nested_v['value']
                     else:
                         value = nested_v
-                    new_line['{}__{}'.format(k, nested_k)] = value
+
+                    column = columns.get(nested_k)
+                    if column is None:
+                        column = '{}__{}'.format(k, nested_k)
+                        columns[nested_k] = column
+                    new_line[column] = value
 
             elif k == 'doc_count':
                 new_line[k] = v
@@ -150,6 +404,25 @@ class ResultTree(object):
         # If there are still buckets, we are not on a leaf
         return 'buckets' not in node
 
+    def _has_buckets_left(self, buckets):
+        return self._bucket_cursors.get(id(buckets), 0) < len(buckets)
+
+    def _first_bucket_key(self, buckets):
+        # Buckets are walked with a cursor, we never shrink them
+        cursor = self._bucket_cursors.get(id(buckets), 0)
+        if isinstance(buckets, list):
+            return cursor
+
+        # Keyed buckets are sorted only once
+        if id(buckets) not in self._sorted_bucket_keys:
+            self._sorted_bucket_keys[id(buckets)] = [
+                key for key, _ in _iter_buckets(buckets)]
+        return self._sorted_bucket_keys[id(buckets)][cursor]
+
+    def _consume_bucket(self, buckets):
+        self._bucket_cursors[id(buckets)] = \
+            self._bucket_cursors.get(id(buckets), 0) + 1
+
     def _find_deeper_path(self, node):
         # The path should always end right before
         # a buckets node, or lead to a leaf
@@ -159,13 +432,9 @@ class ResultTree(object):
         path.append('buckets')
         buckets = node['buckets']
 
-        if isinstance(buckets, list):
-            path.append(0)
-            next_node = buckets[0]
-        elif isinstance(buckets, dict):
-            first_key = sorted(buckets.keys())[0]
-            path.append(first_key)
-            next_node = buckets[first_key]
+        first_key = self._first_bucket_key(buckets)
+        path.append(first_key)
+        next_node = buckets[first_key]
 
         # We find the next key if there is one
         next_key = [k for k in next_node.keys() if k not in RESERVED_KEYS]
@@ -208,6 +477,10 @@ class ResultTree(object):
         path = [current_key]
         node = aggregations[current_key]
 
+        # Index of the next bucket to visit, for each list or dict of buckets
+        self._bucket_cursors = {}
+        self._sorted_bucket_keys = {}
+
         while True:
             # We get the current node using the path
             node = aggregations
@@ -220,12 +493,12 @@ class ResultTree(object):
                 new_line = self._create_line(base_line, node)
                 lines.append(new_line)
 
-                # We delete the leaf
+                # We move on to the next bucket
                 parent = aggregations
                 for key in path[:-1]:
                     parent = parent[key]
 
-                del parent[path[-1]]
+                self._consume_bucket(parent)
 
                 # We update the path
                 path.pop()
@@ -241,9 +514,10 @@ class ResultTree(object):
                 lines.append(others_line)
 
             buckets = node['buckets']
+            has_buckets_left = self._has_buckets_left(buckets)
 
             # If there are no more buckets, and we are at depth 0
-            if not buckets and depth == 0:
+            if not has_buckets_left and depth == 0:
                 # If there is another level 0 aggregation, we work on it
                 next_key = [
                     k for k in aggregations.keys()
@@ -261,7 +535,7 @@ class ResultTree(object):
 
             # If there are no more buckets but we're not at depth 0,
             # either there is another aggregation at our depth or we go higher
-            if not buckets:
+            if not has_buckets_left:
                 # Buckets may have been empty from the start
                 base_line.pop(current_key, None)
 
@@ -275,8 +549,8 @@ class ResultTree(object):
                     if k not in RESERVED_KEYS and k != current_key
                 ]
                 if not next_key:
-                    # No, we delete whole bucket
-                    del parent_bucket[path[-2]]
+                    # No, we are done with the whole bucket
+                    self._consume_bucket(parent_bucket)
 
                     # We update the path, the depth and the current_key
                     path.pop()  # current_key
@@ -297,14 +571,13 @@ class ResultTree(object):
                 continue
 
             # We need to go one level deeper
+            first_key = self._first_bucket_key(buckets)
             if isinstance(buckets, list):
-                bucket = buckets[0]
+                bucket = buckets[first_key]
                 base_line.update({
                     current_key: bucket['key'],
                 })
             elif isinstance(buckets, dict):
-                first_key = sorted(buckets.keys())[0]
-                bucket = buckets[first_key]
                 base_line.update({
                     current_key: first_key,
                 })
@@ -316,3 +589,199 @@ class ResultTree(object):
             depth += 1
 
         return lines
+
+    def _walk_lines(self, aggregations):
+        # Single pass engine: every bucket is visited exactly once, and the
+        # lines share a base line holding the keys of the current branch.
+        # The source tree is never modified nor copied, and lines are
+        # yielded as soon as their bucket is visited.
+        base_line = {}
+
+        current_key = self._bootstrap_current_key(aggregations)
+        node = aggregations[current_key]
+
+        # Are we dealing with a metric without aggs?
+        if 'buckets' not in node and 'doc_count' not in node:
+            yield {
+                key: aggregations[key]['value']
+                for key in aggregations.keys()
+            }
+            return
+
+        aggregations = self._nested_view(aggregations, parent_is_root=True)
+
+        # A single bucket aggregation holding metrics, e.g. a filter, is
+        # merged with the root: it makes a single line
+        if 'doc_count' in aggregations and not any(
+                isinstance(child_node, dict)
+                and ('buckets' in child_node or 'doc_count' in child_node)
+                for key, child_node in aggregations.items()
+                if key not in RESERVED_KEYS):
+            yield self._create_line(base_line, aggregations)
+            return
+
+        for key in self._top_level_keys(aggregations):
+            for line in self._walk_aggregation(
+                    base_line, key, aggregations[key]):
+                yield line
+
+    def _top_level_keys(self, aggregations):
+        # We keep the same ordering as `_extract_lines`
+        first_key = self._bootstrap_current_key(aggregations)
+        return [first_key] + [
+            k for k in aggregations.keys()
+            if k not in RESERVED_KEYS and k != first_key
+        ]
+
+    def _walk_aggregation(self, base_line, key, node):
+        if 'buckets' not in node:
+            # Single bucket aggregation, e.g. a nested aggregation we kept
+            if 'doc_count' in node:
+                self._check_single_bucket(key, node)
+                yield self._create_line(base_line, node)
+            return
+
+        if self.add_others_line and 'sum_other_doc_count' in node:
+            yield self._create_others_line(
+                base_line, key, node['sum_other_doc_count'])
+
+        for bucket_key, bucket in _iter_buckets(node['buckets']):
+            base_line[key] = bucket_key
+            for line in self._walk_bucket(
+                    base_line, self._nested_view(bucket)):
+                yield line
+
+        base_line.pop(key, None)
+
+    def _check_single_bucket(self, key, node):
+        # Its line would silently drop the single bucket aggregations below
+        # it, e.g. filters, we do not know how to flatten them
+        if not self.remove_nested_aggregations:
+            return
+
+        for child_key, child_node in node.items():
+            if child_key in RESERVED_KEYS\
+                    or child_key.startswith('reverse_nested'):
+                continue
+            if isinstance(child_node, dict) and 'doc_count' in child_node:
+                raise NotImplementedError(
+                    u'Cannot flatten the aggregation {} below {}'.format(
+                        child_key, key))
+
+    def _walk_bucket(self, base_line, bucket):
+        child_keys = [
+            k for k, child_node in bucket.items()
+            if k not in RESERVED_KEYS
+            and isinstance(child_node, dict) and 'buckets' in child_node
+        ]
+
+        # No more buckets, we are on a leaf
+        if not child_keys:
+            yield self._create_line(base_line, bucket)
+            return
+
+        for key in child_keys:
+            for line in self._walk_aggregation(base_line, key, bucket[key]):
+                yield line
+
+    def _plan_matches(self, aggregations, plan):
+        # We check the plan against the first branch of the result,
+        # if it does not match we fall back on the single pass engine
+        if plan.levels:
+            plan_keys = [plan.levels[0][1]]
+        else:
+            plan_keys = plan.metric_keys
+
+        # Other aggregations, e.g. already on the search, are not planned
+        if any(
+                key not in RESERVED_KEYS and key not in plan_keys
+                for key in aggregations.keys()):
+            return False
+
+        node = aggregations
+        for kind, key in plan.levels:
+            if not isinstance(node.get(key), dict):
+                return False
+            node = node[key]
+
+            if kind == NESTED_LEVEL:
+                continue
+
+            buckets = node.get('buckets')
+            if not buckets:
+                # Nothing to check below an empty level
+                return isinstance(buckets, (list, dict))
+
+            _, node = next(_iter_buckets(buckets))
+
+        if plan.levels and 'doc_count' not in node:
+            return False
+
+        for key in plan.metric_keys:
+            if 'value' not in node.get(key, {}):
+                return False
+
+        for name, keys in plan.reverse_nested.items():
+            reverse_nested_node = node.get(name, {})
+            if 'doc_count' not in reverse_nested_node:
+                return False
+            for key in keys:
+                if 'value' not in reverse_nested_node.get(key, {}):
+                    return False
+
+        return True
+
+    def _walk_plan(self, aggregations, plan):
+        # The shape of the result is given by the plan, we do not need to
+        # guess which nodes are buckets, nested aggregations or metrics
+        if not plan.levels:
+            yield {
+                key: aggregations[key]['value']
+                for key in aggregations.keys()
+            }
+            return
+
+        for line in self._walk_plan_level({}, aggregations, plan, 0):
+            yield line
+
+    def _walk_plan_level(self, base_line, node, plan, depth):
+        if depth == len(plan.levels):
+            yield self._create_plan_line(base_line, node, plan)
+            return
+
+        kind, key = plan.levels[depth]
+        child_node = node[key]
+
+        if kind == NESTED_LEVEL:
+            for line in self._walk_plan_level(
+                    base_line, child_node, plan, depth + 1):
+                yield line
+            return
+
+        if self.add_others_line and 'sum_other_doc_count' in child_node:
+            yield self._create_others_line(
+                base_line, key, child_node['sum_other_doc_count'])
+
+        for bucket_key, bucket in _iter_buckets(child_node['buckets']):
+            base_line[key] = bucket_key
+            for line in self._walk_plan_level(
+                    base_line, bucket, plan, depth + 1):
+                yield line
+
+        base_line.pop(key, None)
+
+    def _create_plan_line(self, base_line, node, plan):
+        new_line = base_line.copy()
+
+        new_line['doc_count'] = node['doc_count']
+
+        for key in plan.metric_keys:
+            new_line[key] = node[key]['value']
+
+        for name, doc_count_column, columns in plan.reverse_nested_columns:
+            reverse_nested_node = node[name]
+            new_line[doc_count_column] = reverse_nested_node['doc_count']
+            for key, column in columns:
+                new_line[column] = reverse_nested_node[key]['value']
+
+        return new_line
@@ -19,6 +19,13 @@ install_requires = [
     'elasticsearch>=6.0.0,<7.0.0',
     'elasticsearch-dsl>=6.0.0,<7.0.0',
 ]
+extras_require = {
+    # elasticsearch 6.X is not compatible with numpy 2
+    'numpy': ['numpy<2.0'],
+    'ijson': ['ijson>=3.1'],
+    # datetime64[ms] columns need pandas 2
+    'pandas': ['pandas>=2.0', 'numpy<2.0'],
+}
 setup_requires = [
     'Babel>=2.3.4',
 ]
@@ -54,6 +61,7 @@ setup(
         where='.',
     ),
     install_requires=install_requires,
+    extras_require=extras_require,
     setup_requires=setup_requires,
     cmdclass={'sdist': Sdist},
     test_suite='fiqs.tests.run_tests.run_all',